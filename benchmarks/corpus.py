@@ -0,0 +1,89 @@
+"""Synthetic question corpora, deterministic for a given size and seed."""
+import random
+
+WORDS = [
+    "deploy", "kubernetes", "pipeline", "login", "password", "vpn", "database",
+    "timeout", "cluster", "certificate", "proxy", "build", "release", "branch",
+    "merge", "docker", "image", "registry", "token", "permission", "access",
+    "network", "latency", "cache", "queue", "worker", "cron", "backup", "restore",
+    "migration", "schema", "index", "query", "replica", "failover", "alert",
+    "dashboard", "metrics", "logging", "trace", "sdk", "api", "endpoint", "gateway",
+    "ssl", "dns", "domain", "bucket", "storage", "quota", "billing", "invoice",
+    "laptop", "monitor", "printer", "wifi", "calendar", "meeting", "holiday",
+    "payroll", "onboarding", "offboarding", "jira", "confluence", "slack", "email",
+]
+
+
+def vocabulary(size):
+    # The real words first, then synthetic ones so big corpora have a long tail
+    return WORDS + ["term{}".format(i) for i in range(max(0, size - len(WORDS)))]
+
+
+def zipfChoice(rng, words, count):
+    # Low ranks are much more frequent, like real keywords, with a long tail
+    return [
+        words[min(int((rng.paretovariate(1.0) - 1) * 10), len(words) - 1)]
+        for _ in range(count)
+    ]
+
+
+def questionRows(size, seed=7):
+    """Rows shaped like "SELECT *" on the questions table."""
+    rng = random.Random(seed)
+    words = vocabulary(max(200, size // 5))
+    rows = []
+    for position in range(size):
+        question = " ".join(zipfChoice(rng, words, rng.randint(6, 20)))
+        answer = " ".join(zipfChoice(rng, words, rng.randint(15, 60)))
+        keywords = ",".join(dict.fromkeys(zipfChoice(rng, words, rng.randint(3, 10))))
+        aux_keywords = ",".join(dict.fromkeys(zipfChoice(rng, words, rng.randint(0, 5))))
+        rows.append(
+            (
+                "{:.6f}".format(1600000000 + position * 60),
+                question,
+                answer,
+                "U{}".format(rng.randint(1, 500)),
+                "U{}".format(rng.randint(1, 500)),
+                "",
+                keywords,
+                aux_keywords,
+                0,
+            )
+        )
+    return rows
+
+
+def slackMessages(size, seed=7):
+    """conversations.history messages and the matching search.messages answers."""
+    rng = random.Random(seed)
+    words = vocabulary(max(200, size // 5))
+    messages = []
+    responses = []
+    for position in range(size):
+        ts = "{:.6f}".format(1600000000 + position * 60)
+        text = " ".join(zipfChoice(rng, words, rng.randint(6, 20))).capitalize()
+        reaction = "done1" if rng.random() < 0.1 else "eyes"
+        messages.append(
+            {
+                "ts": ts,
+                "thread_ts": ts,
+                "user": "U{}".format(rng.randint(1, 500)),
+                "text": text,
+                "reactions": [{"name": reaction, "count": 1, "users": []}],
+            }
+        )
+        if rng.random() < 0.8:
+            reply_ts = "{:.6f}".format(float(ts) + 30)
+            # Replies link back to their thread the way search.messages does
+            permalink = "https://example.slack.com/archives/C1/p{}?thread_ts={}".format(
+                reply_ts.replace(".", ""), ts
+            )
+            responses.append(
+                {
+                    "ts": reply_ts,
+                    "user": "U{}".format(rng.randint(1, 500)),
+                    "text": " ".join(zipfChoice(rng, words, rng.randint(15, 60))),
+                    "permalink": permalink,
+                }
+            )
+    return messages, responses
@@ -0,0 +1,156 @@
+"""Local stand-ins for Slack and MySQL used by the benchmarks."""
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+QUESTIONS_TABLE = "questions"
+VOCABULARY_TABLE = "questions_keywords"
+POSTINGS_TABLE = "questions_keyword_postings"
+
+SCHEMAS = (
+    "CREATE TABLE IF NOT EXISTS " + QUESTIONS_TABLE + " ("
+    "id TEXT PRIMARY KEY, question TEXT, answer TEXT, user_question TEXT, "
+    "user_answer TEXT, related TEXT, keywords TEXT, aux_keywords TEXT, score INTEGER)",
+    "CREATE TABLE IF NOT EXISTS " + VOCABULARY_TABLE + " ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, keyword TEXT NOT NULL UNIQUE)",
+    "CREATE TABLE IF NOT EXISTS " + POSTINGS_TABLE + " ("
+    "question_id TEXT NOT NULL, field INTEGER NOT NULL, keyword_id INTEGER NOT NULL, "
+    "PRIMARY KEY (question_id, field, keyword_id))",
+)
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeWebClient:
+    """Replays synthetic, paginated Slack Web API answers with a fixed latency
+    per call. Only the methods the app uses are implemented."""
+
+    def __init__(self, messages=(), responses=(), users=(), members=(), latency=0.02):
+        self.messages = list(messages)
+        self.responses = list(responses)
+        self.users = list(users)
+        self.members = list(members)
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def _cursorPage(self, items, key, cursor, limit):
+        self._call()
+        start = int(cursor or 0)
+        end = start + limit
+        more = end < len(items)
+        return FakeResponse(
+            {
+                key: items[start:end],
+                "has_more": more,
+                "response_metadata": {"next_cursor": str(end) if more else ""},
+            }
+        )
+
+    def conversations_history(self, cursor=None, limit=100, **kwargs):
+        return self._cursorPage(self.messages, "messages", cursor, limit)
+
+    def conversations_members(self, cursor=None, limit=100, **kwargs):
+        return self._cursorPage(self.members, "members", cursor, limit)
+
+    def users_list(self, cursor=None, limit=200, **kwargs):
+        return self._cursorPage(self.users, "members", cursor, limit)
+
+    def users_info(self, user=None, **kwargs):
+        self._call()
+        return FakeResponse({"user": {"id": user}})
+
+    def search_messages(self, page=1, count=100, **kwargs):
+        self._call()
+        pages = max(1, -(-len(self.responses) // count))
+        start = (page - 1) * count
+        return FakeResponse(
+            {
+                "messages": {
+                    "matches": self.responses[start : start + count],
+                    "paging": {"page": page, "pages": pages, "count": count},
+                }
+            }
+        )
+
+
+def toSQLite(statement):
+    """Rewrites the MySQL dialect used by the app into SQLite."""
+    statement = re.sub(r"%\((\w+)\)s", r":\1", statement)
+    statement = statement.replace("%s", "?")
+    statement = statement.replace("INSERT IGNORE", "INSERT OR IGNORE")
+    statement = statement.replace(" LOCK IN SHARE MODE", "")
+    upsert = re.search(r" ON DUPLICATE KEY UPDATE (.*)$", statement, re.S)
+    if upsert:
+        columns = re.findall(r"(\w+)=VALUES\(\1\)", upsert.group(1))
+        statement = (
+            statement[: upsert.start()]
+            + " ON CONFLICT(id) DO UPDATE SET "
+            + ",".join("{0}=excluded.{0}".format(column) for column in columns)
+        )
+    return statement
+
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, statement, params=()):
+        self._cursor.execute(toSQLite(statement), params)
+
+    def executemany(self, statement, params):
+        self._cursor.executemany(toSQLite(statement), params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteDatabase:
+    """In-process replacement for database.connection()."""
+
+    def __init__(self, path=":memory:"):
+        self._cnx = sqlite3.connect(path, check_same_thread=False)
+        for schema in SCHEMAS:
+            self._cnx.execute(schema)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def connection(self):
+        with self._lock:
+            yield self
+
+    def cursor(self):
+        return SQLiteCursor(self._cnx.cursor())
+
+    def commit(self):
+        self._cnx.commit()
+
+    def close(self):
+        pass
+
+    def loadRows(self, rows):
+        self._cnx.executemany(
+            "INSERT OR REPLACE INTO " + QUESTIONS_TABLE + " VALUES (?,?,?,?,?,?,?,?,?)",
+            rows,
+        )
+        self._cnx.commit()
@@ -0,0 +1,300 @@
+"""Offline benchmarks of the search, related, import and pagination hot paths.
+
+    python -m benchmarks.run --sizes 1000,10000 --output report.json
+    python -m benchmarks.run --sizes 1000,10000 --compare report.json
+
+Slack is replaced by FakeWebClient and MySQL by SQLite (benchmarks/fakes.py),
+so nothing here touches the network. Reports are JSON; --compare exits with
+status 1 when a benchmark got slower than the baseline by more than
+--threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import database
+import importer
+import keyword_vocabulary
+import search_index
+import slack_pagination
+import update_related
+from benchmarks import corpus
+from benchmarks.fakes import (
+    FakeWebClient,
+    POSTINGS_TABLE,
+    QUESTIONS_TABLE,
+    SQLiteDatabase,
+    VOCABULARY_TABLE,
+)
+
+SEARCH_QUERIES = 200
+# Share of the corpus added as new questions for the incremental related run
+RELATED_DELTA = 0.01
+# extractKeywords is slow enough that bigger sizes only measure NLTK
+KEYWORD_MAX_MESSAGES = 2000
+
+
+def timed(function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def useStandIns(state_dir, patch=setattr):
+    """Points the app modules at a fresh SQLite database and lifts the Slack
+    rate limits, which would otherwise dominate the timings. Every change goes
+    through patch(module, name, value), so tests can pass monkeypatch.setattr
+    to have them undone."""
+    stand_in = SQLiteDatabase()
+    patch(database, "connection", stand_in.connection)
+    patch(importer, "DATABASE_TABLE", QUESTIONS_TABLE)
+    patch(update_related, "DATABASE_TABLE", QUESTIONS_TABLE)
+    patch(keyword_vocabulary, "DATABASE_TABLE", QUESTIONS_TABLE)
+    patch(keyword_vocabulary, "VOCABULARY_TABLE", VOCABULARY_TABLE)
+    patch(keyword_vocabulary, "POSTINGS_TABLE", POSTINGS_TABLE)
+    # The stand-in creates the tables itself
+    patch(keyword_vocabulary, "_tables_ready", True)
+    patch(keyword_vocabulary, "_ids", {})
+    patch(
+        update_related,
+        "RELATED_STATE_FILE",
+        os.path.join(state_dir, "related_state.json"),
+    )
+    patch(slack_pagination, "DEFAULT_RATE_LIMIT", 10**9)
+    patch(
+        slack_pagination,
+        "METHOD_RATE_LIMITS",
+        {method: 10**9 for method in slack_pagination.METHOD_RATE_LIMITS},
+    )
+    patch(slack_pagination, "_buckets", {})
+    return stand_in
+
+
+def benchSearch(rows, rng):
+    rebuild_seconds, _ = timed(search_index.rebuild, rows)
+    latencies = []
+    for _ in range(SEARCH_QUERIES):
+        query = " ".join(rng.sample(corpus.WORDS, rng.randint(1, 2)))
+        seconds, _ = timed(search_index.search, query, limit=50)
+        latencies.append(seconds)
+    latencies.sort()
+    return {
+        "seconds": rebuild_seconds,
+        "query_mean_seconds": statistics.mean(latencies),
+        "query_p95_seconds": latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def loadQuestions(stand_in, rows):
+    # Rows and their keyword postings, as insertData would have written them
+    stand_in.loadRows(rows)
+    with stand_in.connection() as cnx:
+        keyword_vocabulary.writePostings(
+            cnx.cursor(),
+            [
+                (row[0], keyword_vocabulary.splitColumn(row[6]),
+                 keyword_vocabulary.splitColumn(row[7]))
+                for row in rows
+            ],
+        )
+        cnx.commit()
+
+
+def benchRelated(rows, state_dir):
+    delta = max(1, int(len(rows) * RELATED_DELTA))
+    stand_in = useStandIns(state_dir)
+    loadQuestions(stand_in, rows[:-delta])
+    full_seconds, _ = timed(update_related.updateRelatedQuestions, incremental=False)
+    loadQuestions(stand_in, rows[-delta:])
+    incremental_seconds, updated = timed(
+        update_related.updateRelatedQuestions, incremental=True
+    )
+    return {
+        "seconds": full_seconds,
+        "incremental_seconds": incremental_seconds,
+        "incremental_delta_rows": delta,
+        "incremental_rows_written": updated,
+    }
+
+
+def enrichedElements(rows):
+    return [
+        {
+            "ts": row[0],
+            "text": row[1],
+            "user": row[3],
+            "response": {"text": row[2], "user": row[4]},
+            "related": [],
+            "keywords": row[6].split(","),
+            "aux_keywords": row[7].split(",") if row[7] else [],
+        }
+        for row in rows
+    ]
+
+
+def benchInsert(rows, state_dir):
+    useStandIns(state_dir)
+    elements = enrichedElements(rows)
+    insert_seconds, stats = timed(importer.insertData, elements)
+    upsert_seconds, _ = timed(importer.insertData, elements)
+    return {
+        "seconds": insert_seconds,
+        "rows_per_second": stats["rows_per_second"],
+        "upsert_seconds": upsert_seconds,
+    }
+
+
+def benchEnrich(size):
+    messages, responses = corpus.slackMessages(size)
+    questions = [dict(message) for message in messages]
+    join_seconds, _ = timed(importer.joinResponses, questions, responses)
+    lookup_seconds, lookups = timed(importer.buildResponseLookup, [responses])
+    result = {
+        "seconds": join_seconds,
+        "lookup_seconds": lookup_seconds,
+        "matched": sum(1 for question in questions if "response" in question),
+    }
+
+    importer.NLTK_AUTO_DOWNLOAD = False
+    try:
+        importer.loadNlp()
+    except (ImportError, LookupError) as err:
+        result["keywords_skipped"] = str(err)
+        return result
+    sample = [dict(message) for message in messages[:KEYWORD_MAX_MESSAGES]]
+    keyword_seconds, _ = timed(importer.extractKeywords, sample, workers=1)
+    result["keywords_seconds"] = keyword_seconds
+    result["keywords_messages"] = len(sample)
+    return result
+
+
+def benchPagination(size, latency, state_dir):
+    useStandIns(state_dir)
+    messages, responses = corpus.slackMessages(size)
+    client = FakeWebClient(messages=messages, responses=responses, latency=latency)
+
+    def consume(pages):
+        # Some work per page, so prefetching has something to overlap with
+        count = 0
+        for page in pages:
+            time.sleep(latency / 2)
+            count += 1
+        return count
+
+    history_seconds, history_pages = timed(
+        consume, slack_pagination.paginateCursor(client.conversations_history, limit=500)
+    )
+    search_seconds, search_pages = timed(
+        consume, slack_pagination.paginatePages(client.search_messages, "messages", count=100)
+    )
+    return {
+        "seconds": history_seconds + search_seconds,
+        "history_pages": history_pages,
+        "history_seconds": history_seconds,
+        "search_pages": search_pages,
+        "search_seconds": search_seconds,
+        "sequential_estimate_seconds": (history_pages + search_pages) * latency * 1.5,
+    }
+
+
+def runAll(sizes, latency, benchmarks):
+    results = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        for size in sizes:
+            rng = random.Random(size)
+            rows = corpus.questionRows(size)
+            cases = {
+                "search": lambda: benchSearch(rows, rng),
+                "related": lambda: benchRelated(rows, state_dir),
+                "insert": lambda: benchInsert(rows, state_dir),
+                "enrich": lambda: benchEnrich(size),
+                "pagination": lambda: benchPagination(size, latency, state_dir),
+            }
+            for name in benchmarks:
+                result = cases[name]()
+                result.update({"benchmark": name, "size": size})
+                print(
+                    "{:<11} {:>9} {:>10.4f}s".format(name, size, result["seconds"]),
+                    file=sys.stderr,
+                )
+                results.append(result)
+    return {
+        "meta": {
+            "created": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "latency": latency,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Benchmarks slower than the baseline by more than threshold (0.2 = 20%)."""
+    previous = {
+        (result["benchmark"], result["size"]): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["benchmark"], result["size"]))
+        if before is None or before["seconds"] <= 0:
+            continue
+        ratio = result["seconds"] / before["seconds"]
+        if ratio > 1 + threshold:
+            regressions.append(
+                {
+                    "benchmark": result["benchmark"],
+                    "size": result["size"],
+                    "baseline_seconds": before["seconds"],
+                    "seconds": result["seconds"],
+                    "ratio": ratio,
+                }
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", default="1000,10000", help="comma separated corpus sizes (1k-1M)"
+    )
+    parser.add_argument(
+        "--benchmarks",
+        default="search,related,insert,enrich,pagination",
+        help="comma separated subset to run",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds per fake Slack call"
+    )
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline JSON report")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = runAll(
+        [int(size) for size in args.sizes.split(",")],
+        args.latency,
+        args.benchmarks.split(","),
+    )
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print(
+                "REGRESSION {benchmark} size={size}: {baseline_seconds:.4f}s -> "
+                "{seconds:.4f}s ({ratio:.2f}x)".format(**regression),
+                file=sys.stderr,
+            )
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+import mysql.connector
+from mysql.connector import pooling
+from dotenv import load_dotenv
+import metrics
+
+TEST_MODE = False
+
+# Allows us to access the .env file
+if TEST_MODE:
+    load_dotenv(".env.stage")
+else:
+    load_dotenv(".env.production")
+
+# env variables
+DATABASE_DIRECTION = os.getenv("DATABASE_DIRECTION")
+DATABASE_USER = os.getenv("DATABASE_USER")
+DATABASE_PASSWORD = os.getenv("DATABSE_PASSWORD")
+DATABASE_NAME = os.getenv("DATABASE_NAME")
+DATABASE_TABLE = os.getenv("DATABASE_TABLE")
+# mysql.connector does not allow pools bigger than 32 connections
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+# Seconds a caller waits for a free connection before giving up
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "10"))
+
+POOL_RETRY_DELAY = 0.005
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def getPool():
+    global _pool
+    # Created on first use, so importing this module never opens connections
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="sos_ts",
+                    pool_size=DATABASE_POOL_SIZE,
+                    pool_reset_session=True,
+                    user=DATABASE_NAME,
+                    password=DATABASE_PASSWORD,
+                    host=DATABASE_DIRECTION,
+                    database=DATABASE_NAME,
+                )
+                metrics.setGauge("db_pool_size", DATABASE_POOL_SIZE)
+    return _pool
+
+
+def checkout():
+    pool = getPool()
+    started = time.perf_counter()
+    delay = POOL_RETRY_DELAY
+    while True:
+        try:
+            cnx = pool.get_connection()
+            break
+        except pooling.PoolError:
+            # The pool does not block when it is exhausted, so wait for a connection
+            # to be handed back
+            if time.perf_counter() - started > DATABASE_POOL_TIMEOUT:
+                metrics.increment("db_pool_timeouts_total")
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+    metrics.observe("db_pool_wait_seconds", time.perf_counter() - started)
+
+    # Health check: connections dropped by the server (wait_timeout, restarts...)
+    # are reopened before they are handed out
+    try:
+        cnx.ping(reconnect=False)
+    except mysql.connector.Error:
+        metrics.increment("db_pool_reconnects_total")
+        try:
+            cnx.reconnect(attempts=2, delay=0)
+        except mysql.connector.Error:
+            cnx.close()
+            raise
+    metrics.increment("db_pool_checkouts_total")
+    return cnx
+
+
+def statementKind(statement):
+    # First keyword of the statement, the "operation" label of the query metrics
+    return statement.lstrip().split(None, 1)[0].lower() if statement.strip() else "unknown"
+
+
+class InstrumentedCursor:
+    """Cursor wrapper recording the duration and row count of every query."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._operation = "unknown"
+
+    def execute(self, statement, params=None):
+        self._operation = statementKind(statement)
+        with metrics.timed("db_query", operation=self._operation):
+            result = self._cursor.execute(statement, params)
+        self._countWritten()
+        return result
+
+    def executemany(self, statement, seq_params):
+        self._operation = statementKind(statement)
+        with metrics.timed("db_query", operation=self._operation):
+            result = self._cursor.executemany(statement, seq_params)
+        self._countWritten()
+        return result
+
+    def fetchall(self):
+        with metrics.timed("db_fetch", operation=self._operation):
+            rows = self._cursor.fetchall()
+        metrics.increment("db_rows_total", len(rows), operation=self._operation)
+        return rows
+
+    def fetchmany(self, size=1):
+        with metrics.timed("db_fetch", operation=self._operation):
+            rows = self._cursor.fetchmany(size)
+        metrics.increment("db_rows_total", len(rows), operation=self._operation)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            metrics.increment("db_rows_total", operation=self._operation)
+        return row
+
+    def _countWritten(self):
+        if self._operation != "select" and self._cursor.rowcount > 0:
+            metrics.increment(
+                "db_rows_total", self._cursor.rowcount, operation=self._operation
+            )
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    def __init__(self, cnx):
+        self._cnx = cnx
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._cnx.cursor(*args, **kwargs))
+
+    def commit(self):
+        with metrics.timed("db_commit"):
+            self._cnx.commit()
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+
+@contextmanager
+def connection():
+    """Pooled connection, handed back to the pool when the block ends. Queries
+    run through it are timed (see InstrumentedCursor)."""
+    cnx = checkout()
+    try:
+        yield InstrumentedConnection(cnx)
+    finally:
+        # For pooled connections close() returns them to the pool
+        cnx.close()
@@ -1,21 +1,24 @@
-import mysql.connector
-import nltk
-from rake_nltk import Rake
 from itertools import chain
-from nltk.corpus import wordnet
+from concurrent.futures import ProcessPoolExecutor
 import re
 import os
+import sys
+import argparse
 import datetime
+import gzip
+import json
+import logging
+import multiprocessing
+import threading
 import time
 from slack_sdk import WebClient
 from dotenv import load_dotenv
-
-nltk.download("stopwords")
-nltk.download("punkt")
-nltk.download("wordnet")
-
-
-rake_class = Rake()
+import database
+import keyword_vocabulary
+import metrics
+import question_counter
+import slack_pagination
+from lru_cache import LRUCache
 
 MESSAGE_BATCH_SIZE = 100
 TEST_MODE = False
@@ -31,14 +34,115 @@ SLACK_APP_TOKEN = os.getenv("SLACK_APP_TOKEN")
 SLACK_CHANNEL_ID = os.getenv("SLACK_CHANNEL_ID")
 CHANNEL_NAME = os.getenv("CHANNEL_NAME")
 TOKEN_FOR_SEARCH = os.getenv("TOKEN_FOR_SEARCH")
-DATABASE_DIRECTION=os.getenv("DATABASE_DIRECTION")
-DATABASE_USER=os.getenv("DATABASE_USER")
-DATABASE_PASSWORD=os.getenv("DATABSE_PASSWORD")
-DATABASE_NAME=os.getenv("DATABASE_NAME")
 DATABASE_TABLE=os.getenv("DATABASE_TABLE")
+# Rows per multi-row INSERT statement in insertData
+INSERT_CHUNK_SIZE = int(os.getenv("INSERT_CHUNK_SIZE", "500"))
+# Processes used by extractKeywords, 1 keeps it in this process
+KEYWORD_WORKERS = int(os.getenv("KEYWORD_WORKERS", str(os.cpu_count() or 1)))
+# Messages sent to a worker at a time
+KEYWORD_CHUNK_SIZE = 50
+# Phrase -> WordNet synonyms, kept between imports
+SYNONYM_CACHE_SIZE = int(os.getenv("SYNONYM_CACHE_SIZE", "50000"))
+SYNONYM_CACHE_FILE = "user_data/synonyms.json.gz"
+# Watermark of the last import and progress of a running backfill
+IMPORT_STATE_FILE = "user_data/import_state.json"
+# How long an unanswered question keeps being re-imported waiting for its answer
+IMPORT_PENDING_DAYS = 7
+# Days fetched, enriched and inserted at a time by a backfill
+IMPORT_CHUNK_DAYS = 7
+# Questions joined, enriched and inserted together by the import stream
+IMPORT_BATCH_SIZE = 500
+# Download missing NLTK data on first use; disable on hosts provisioned offline
+NLTK_AUTO_DOWNLOAD = os.getenv("NLTK_AUTO_DOWNLOAD", "true").lower() == "true"
+# Where `provision` downloads the NLTK data and where it is looked up first.
+# Unset, NLTK's own default locations (and NLTK_DATA) are used.
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR")
+
+# NLTK packages needed by RAKE and the synonyms, and where nltk.data finds them
+NLTK_RESOURCES = {
+    "stopwords": "corpora/stopwords",
+    "punkt": "tokenizers/punkt",
+    "wordnet": "corpora/wordnet",
+}
 
-client = WebClient(SLACK_APP_TOKEN)
 channel_id = SLACK_CHANNEL_ID
+synonym_cache = LRUCache(SYNONYM_CACHE_SIZE)
+
+# Created on first use: importing this module (main.py does) must not touch
+# Slack or NLTK
+_client = None
+rake_class = None
+wordnet = None
+_nlp_lock = threading.Lock()
+
+
+def getClient():
+    global _client
+    if _client is None:
+        _client = WebClient(SLACK_APP_TOKEN)
+    return _client
+
+
+def missingNlpResources():
+    import nltk
+
+    if NLTK_DATA_DIR and NLTK_DATA_DIR not in nltk.data.path:
+        nltk.data.path.insert(0, NLTK_DATA_DIR)
+    missing = []
+    for name, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            try:
+                nltk.data.find(path + ".zip")
+            except LookupError:
+                missing.append(name)
+    return missing
+
+
+def provisionNlpResources(download_dir=None):
+    """Downloads the NLTK data and returns the resources still missing."""
+    global NLTK_DATA_DIR
+    import nltk
+
+    if download_dir is not None:
+        NLTK_DATA_DIR = download_dir
+    for name in NLTK_RESOURCES:
+        if not nltk.download(name, download_dir=NLTK_DATA_DIR, quiet=True):
+            logging.error("Could not download the NLTK package {}".format(name))
+    return missingNlpResources()
+
+
+def loadNlp():
+    global rake_class, wordnet
+    if rake_class is not None:
+        return
+    with _nlp_lock:
+        if rake_class is not None:
+            return
+        missing = missingNlpResources()
+        if missing:
+            if not NLTK_AUTO_DOWNLOAD:
+                raise LookupError(
+                    "Missing NLTK data {}, run `python importer.py provision`".format(
+                        ", ".join(missing)
+                    )
+                )
+            import nltk
+
+            for name in missing:
+                nltk.download(name, download_dir=NLTK_DATA_DIR, quiet=True)
+
+        from nltk.corpus import wordnet as wordnet_corpus
+
+        wordnet = wordnet_corpus
+        rake_class = newRake()
+
+
+def newRake():
+    from rake_nltk import Rake
+
+    return Rake()
 
 
 def CheckLeap(year):
@@ -49,74 +153,57 @@ def CheckLeap(year):
         return 28
 
 
+def isOpenQuestion(message):
+    # Only messages with reactions and without the done1 one are questions to import
+    if "reactions" not in message:
+        return False
+    return all(reaction["name"] != "done1" for reaction in message["reactions"])
+
+
 # both in timestamps
-def getQuestions(init_date, final_date):
+def iterQuestions(init_date, final_date):
     # Generate the timestamps that are required to make the request in the Slack API
     oldest = time.mktime(init_date.timetuple())
     latest = time.mktime(final_date.timetuple())
 
-    # Request to the Slack API
-    all_messages = []
-    cursor_id = None
-    intitial_loop = True
-    while cursor_id is not None or intitial_loop:
-        intitial_loop = False
-        result = client.conversations_history(
-            channel=channel_id,
-            latest=latest,
-            oldest=oldest,
-            inclusive=True,
-            include_all_metadata=True,
-            limit=500,
-            cursor=cursor_id,
-        )
-        all_messages += result.data["messages"]
-        if result.data["has_more"] is True:
-            cursor_id = result.data["response_metadata"]["next_cursor"]
-        else:
-            cursor_id = None
-    print(all_messages)
-
-    # Check for done and remove if true
-    cleaned_questions = []
-    for message in all_messages:
-        addToQuestions = True
-        if "reactions" in message:
-            for reaction in message["reactions"]:
-                if reaction["name"] == "done1":
-                    addToQuestions = False
-            if addToQuestions:
-                cleaned_questions.append(message)
-
-    return cleaned_questions
+    # Request to the Slack API, one list of open questions per page
+    for result in slack_pagination.paginateCursor(
+        getClient().conversations_history,
+        channel=channel_id,
+        latest=latest,
+        oldest=oldest,
+        inclusive=True,
+        include_all_metadata=True,
+        limit=500,
+    ):
+        yield [message for message in result["messages"] if isOpenQuestion(message)]
 
 
-def getResponses(init_date, final_date):
-    responses = []
-    actual_page = 0
-    final_page = 0
-    init_date_formatted = init_date.strftime("%Y-%m-%d")
-    final_date_formatted = final_date.strftime("%Y-%m-%d")
-
-    # Get all users id that pertain to the channel
-    while actual_page <= final_page:
-        data_retrieved = client.search_messages(
-            page=actual_page,
-            count=MESSAGE_BATCH_SIZE,
-            token=TOKEN_FOR_SEARCH,
-            query="in:sos_ts is:thread has::green_check_mark: before:{} after:{} ".format(
-                final_date_formatted, init_date_formatted
-            ),
-        )
+def getQuestions(init_date, final_date):
+    return list(chain.from_iterable(iterQuestions(init_date, final_date)))
 
-        responses += data_retrieved.data["messages"]["matches"]
 
-        if final_page == -1:
-            final_page = data_retrieved.data["messages"]["paging"]["pages"]
+def iterResponses(init_date, final_date):
+    # Slack's before: and after: exclude the day they name
+    init_date_formatted = (init_date - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    final_date_formatted = (final_date + datetime.timedelta(days=1)).strftime(
+        "%Y-%m-%d"
+    )
 
-        actual_page += 1
+    for data_retrieved in slack_pagination.paginatePages(
+        getClient().search_messages,
+        "messages",
+        count=MESSAGE_BATCH_SIZE,
+        token=TOKEN_FOR_SEARCH,
+        query="in:sos_ts is:thread has::green_check_mark: before:{} after:{} ".format(
+            final_date_formatted, init_date_formatted
+        ),
+    ):
+        yield data_retrieved["messages"]["matches"]
 
-    return responses
+
+def getResponses(init_date, final_date):
+    return list(chain.from_iterable(iterResponses(init_date, final_date)))
 
 
 def importData(init_date, final_date):
@@ -125,105 +212,517 @@ def importData(init_date, final_date):
     return questions, responses
 
 
-def extractKeywords(questions):
-    cleanedData = []
-    for each_message in questions:
-        if "subtype" not in each_message:
-            rake_class.extract_keywords_from_text(each_message["text"])
-        extracted_keyword = rake_class.get_ranked_phrases()
-        aux = []
-        for each_extracted_keyword in extracted_keyword:
-            synonyms = wordnet.synsets(each_extracted_keyword)
-            aux = list(
-                set(chain.from_iterable([word.lemma_names() for word in synonyms]))
+def getSynonyms(phrase, cache, new_entries=None):
+    synonyms = cache.get(phrase)
+    if synonyms is None:
+        # Sorted so every process produces the same order regardless of hash seed
+        synonyms = sorted(
+            set(
+                chain.from_iterable(
+                    [word.lemma_names() for word in wordnet.synsets(phrase)]
+                )
             )
-        each_message["keywords"] = extracted_keyword
-        upper_case_words = re.split(r"\s+[a-z][a-z\s]*", each_message["text"])
-        each_message["keywords"].extend([x.lower() for x in upper_case_words])
+        )
+        cache.put(phrase, synonyms)
+        if new_entries is not None:
+            new_entries[phrase] = synonyms
+    return synonyms
+
+
+def loadSynonymCache(path=SYNONYM_CACHE_FILE):
+    try:
+        with gzip.open(path, "rt") as cache_file:
+            entries = json.load(cache_file)
+    except FileNotFoundError:
+        return
+    for phrase, synonyms in entries:
+        synonym_cache.put(phrase, synonyms)
+
+
+def saveSynonymCache(path=SYNONYM_CACHE_FILE):
+    temporary_file = path + ".tmp"
+    with gzip.open(temporary_file, "wt") as cache_file:
+        json.dump(synonym_cache.items(), cache_file, separators=(",", ":"))
+    os.replace(temporary_file, path)
+
+
+def extractMessageKeywords(rake, text, has_subtype, synonyms, new_synonyms=None):
+    # Messages with a subtype (joins, bot messages...) get no RAKE phrases
+    extracted_keyword = []
+    if not has_subtype:
+        rake.extract_keywords_from_text(text)
+        extracted_keyword = rake.get_ranked_phrases()
+    aux = []
+    for each_extracted_keyword in extracted_keyword:
+        aux = list(getSynonyms(each_extracted_keyword, synonyms, new_synonyms))
+    keywords = list(extracted_keyword)
+    upper_case_words = re.split(r"\s+[a-z][a-z\s]*", text)
+    keywords.extend([x.lower() for x in upper_case_words])
+    return keywords, aux
+
+
+_worker_rake = None
+_worker_synonyms = None
+
+
+def _initKeywordWorker(synonym_entries):
+    # Each worker process gets its own Rake instance, they are not shareable, and
+    # its own copy of the synonym cache
+    global _worker_rake, _worker_synonyms
+    loadNlp()
+    _worker_rake = newRake()
+    _worker_synonyms = LRUCache(SYNONYM_CACHE_SIZE)
+    for phrase, synonyms in synonym_entries:
+        _worker_synonyms.put(phrase, synonyms)
+
+
+def _extractKeywordsChunk(messages):
+    # The new synonyms and the counters go back to the parent's cache
+    new_synonyms = {}
+    hits, misses = _worker_synonyms.hits, _worker_synonyms.misses
+    results = [
+        extractMessageKeywords(
+            _worker_rake, text, has_subtype, _worker_synonyms, new_synonyms
+        )
+        for text, has_subtype in messages
+    ]
+    return (
+        results,
+        new_synonyms,
+        _worker_synonyms.hits - hits,
+        _worker_synonyms.misses - misses,
+    )
+
+
+def newKeywordPool(workers=KEYWORD_WORKERS):
+    # Never fork: the pool is started from a job thread of the API process, and
+    # forking a process with other threads running can deadlock the children
+    start_method = (
+        "forkserver"
+        if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn"
+    )
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_initKeywordWorker,
+        initargs=(synonym_cache.items(),),
+    )
+
+
+def extractKeywordsInPool(pool, messages):
+    chunks = [
+        messages[start : start + KEYWORD_CHUNK_SIZE]
+        for start in range(0, len(messages), KEYWORD_CHUNK_SIZE)
+    ]
+    results = []
+    for chunk_results, new_synonyms, chunk_hits, chunk_misses in pool.map(
+        _extractKeywordsChunk, chunks
+    ):
+        results.extend(chunk_results)
+        for phrase, synonyms in new_synonyms.items():
+            synonym_cache.put(phrase, synonyms)
+        synonym_cache.hits += chunk_hits
+        synonym_cache.misses += chunk_misses
+    return results
+
+
+def extractKeywords(questions, workers=KEYWORD_WORKERS, pool=None):
+    # Uses the given pool if any, so a stream of batches reuses the same workers
+    loadNlp()
+    messages = [
+        (each_message.get("text", ""), "subtype" in each_message)
+        for each_message in questions
+    ]
+    hits, misses = synonym_cache.hits, synonym_cache.misses
+    if pool is not None:
+        results = extractKeywordsInPool(pool, messages)
+    elif workers <= 1 or len(messages) <= KEYWORD_CHUNK_SIZE:
+        results = [
+            extractMessageKeywords(rake_class, text, has_subtype, synonym_cache)
+            for text, has_subtype in messages
+        ]
+    else:
+        with newKeywordPool(workers) as pool:
+            results = extractKeywordsInPool(pool, messages)
+    metrics.increment("synonym_cache_hits_total", synonym_cache.hits - hits)
+    metrics.increment("synonym_cache_misses_total", synonym_cache.misses - misses)
+    metrics.setGauge("synonym_cache_entries", len(synonym_cache))
+
+    cleanedData = []
+    for each_message, (keywords, aux) in zip(questions, results):
+        each_message["keywords"] = keywords
         each_message["aux_keywords"] = aux
         each_message["related"] = []
         cleanedData.append(each_message)
     return cleanedData
 
 
+def joinResponses(cleanedData, responses):
+    # Lookup tables built once: the first question with a given permalink or
+    # thread_ts wins, as it did with the nested loop
+    by_permalink = {}
+    by_thread_ts = {}
+    for position, each_enriched_question in enumerate(cleanedData):
+        if "permalink" in each_enriched_question:
+            by_permalink.setdefault(each_enriched_question["permalink"], position)
+        if "thread_ts" in each_enriched_question:
+            by_thread_ts.setdefault(each_enriched_question["thread_ts"], position)
+
+    for each_response in responses:
+        if "permalink" not in each_response:
+            continue
+        permalink = each_response["permalink"]
+        matches = []
+        if permalink in by_permalink:
+            matches.append(by_permalink[permalink])
+        if "thread_ts=" in permalink:
+            thread_ts = permalink.split("thread_ts=")[1]
+            if thread_ts in by_thread_ts:
+                matches.append(by_thread_ts[thread_ts])
+        if matches:
+            cleanedData[min(matches)]["response"] = each_response
+
+
+def buildResponseLookup(response_pages):
+    """permalink -> response and thread_ts -> response tables, keeping only the
+    fields insertData needs. Later responses win, as in joinResponses."""
+    by_permalink = {}
+    by_thread_ts = {}
+    for position, each_response in enumerate(chain.from_iterable(response_pages)):
+        if "permalink" not in each_response:
+            continue
+        permalink = each_response["permalink"]
+        response = (
+            position,
+            {
+                "text": each_response.get("text", ""),
+                "user": each_response.get("user"),
+                "permalink": permalink,
+            },
+        )
+        by_permalink[permalink] = response
+        if "thread_ts=" in permalink:
+            by_thread_ts[permalink.split("thread_ts=")[1]] = response
+    return by_permalink, by_thread_ts
+
+
+def findResponse(question, by_permalink, by_thread_ts):
+    matches = []
+    if "permalink" in question and question["permalink"] in by_permalink:
+        matches.append(by_permalink[question["permalink"]])
+    if "thread_ts" in question and question["thread_ts"] in by_thread_ts:
+        matches.append(by_thread_ts[question["thread_ts"]])
+    if not matches:
+        return None
+    return max(matches, key=lambda match: match[0])[1]
+
+
+def iterBatches(pages, batch_size):
+    batch = []
+    for page in pages:
+        batch.extend(page)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def isValidKeyword(keyword):
+    # Emojis (":emoji:") and empty strings are not keywords
+    return len(keyword) > 0 and not (keyword[0] == ":" and keyword[-1] == ":")
+
+
 def enrichData(questions, responses):
     cleanedData = extractKeywords(questions)
-    for each_response in responses:
-        for each_enriched_question in cleanedData:
-            if (
-                "permalink" in each_enriched_question
-                and "permalink" in each_response
-                and each_enriched_question["permalink"] == each_response["permalink"]
-            ):
-                each_enriched_question["response"] = each_response
-                break
-            if (
-                "thread_ts" in each_enriched_question
-                and "permalink" in each_response
-                and each_enriched_question["thread_ts"]
-                == each_response["permalink"].split("thread_ts=")[1]
-            ):
-                each_enriched_question["response"] = each_response
-                break
+    joinResponses(cleanedData, responses)
 
     finalData = []
     for question in cleanedData:
         if "response" in question:
-            question["keywords"] = [str(i) for i in question["keywords"]]
-            for index, keyword in enumerate(question["keywords"]):
-                if len(keyword) > 0 and keyword[0] == ":" and keyword[-1] == ":":
-                    question["keywords"].remove(keyword)
-                elif len(keyword) == 0:
-                    del question["keywords"][index]
+            question["keywords"] = [
+                str(i) for i in question["keywords"] if isValidKeyword(str(i))
+            ]
             finalData.append(question)
 
     return finalData
 
 
-def insertData(data):
-    cnx = mysql.connector.connect(
-        user=DATABASE_NAME, password=DATABASE_PASSWORD, host=DATABASE_DIRECTION, database=DATABASE_NAME
+def insertData(data, chunk_size=INSERT_CHUNK_SIZE):
+    # Upserts keyed on id (the message ts): re-importing an overlapping window
+    # refreshes the rows instead of failing on duplicates. related and score are
+    # left alone, they belong to the related job and the users.
+    columns = (
+        "id",
+        "question",
+        "answer",
+        "user_question",
+        "user_answer",
+        "related",
+        "keywords",
+        "aux_keywords",
+        "score",
+    )
+    updated_columns = (
+        "question",
+        "answer",
+        "user_question",
+        "user_answer",
+        "keywords",
+        "aux_keywords",
     )
 
-    cursor = cnx.cursor()
+    questions = []
+    for element in data:
+        questions.append(
+            (
+                element["ts"],
+                element["text"][:10000],
+                element["response"]["text"][:10000],
+                element["user"],
+                element["response"]["user"],
+                str(",".join([item[0] for item in element["related"]][:10])),
+                str(",".join(element["keywords"])),
+                str(",".join(element["aux_keywords"])),
+                0,
+            )
+        )
 
-    add_question = (
-        "INSERT INTO " + DATABASE_TABLE + " "
-        "(id, question, answer, user_question,user_answer,related,keywords,aux_keywords,score) "
-        "VALUES (%(id)s, %(question)s, %(answer)s, %(user_question)s,%(user_answer)s,"
-        "%(related)s,%(keywords)s,%(aux_keywords)s,%(score)s)"
+    started = time.perf_counter()
+    with database.connection() as cnx:
+        keyword_vocabulary.ensureTables(cnx)
+        cursor = cnx.cursor()
+        for start in range(0, len(questions), chunk_size):
+            chunk = questions[start : start + chunk_size]
+            # Ids already in the table, so the question counter only counts new rows
+            chunk_ids = list({row[0] for row in chunk})
+            cursor.execute(
+                "SELECT COUNT(*) FROM " + DATABASE_TABLE + " WHERE id IN ("
+                + ", ".join(["%s"] * len(chunk_ids))
+                + ")",
+                chunk_ids,
+            )
+            existing = cursor.fetchall()[0][0]
+            add_questions = (
+                "INSERT INTO " + DATABASE_TABLE + " "
+                "(" + ",".join(columns) + ") VALUES "
+                + ",".join(["(" + ",".join(["%s"] * len(columns)) + ")"] * len(chunk))
+                + " ON DUPLICATE KEY UPDATE "
+                + ",".join(
+                    "{0}=VALUES({0})".format(column) for column in updated_columns
+                )
+            )
+            cursor.execute(add_questions, [value for row in chunk for value in row])
+            # Same transaction as the rows. Built from the joined columns, exactly
+            # as indexAllQuestions does: keywords can contain commas themselves
+            keyword_vocabulary.writePostings(
+                cursor,
+                [
+                    (
+                        row[0],
+                        keyword_vocabulary.splitColumn(row[6]),
+                        keyword_vocabulary.splitColumn(row[7]),
+                    )
+                    for row in chunk
+                ],
+            )
+            cnx.commit()
+            question_counter.addCount(len(chunk_ids) - existing)
+        cursor.close()
+
+    elapsed = time.perf_counter() - started
+    rows_per_second = len(questions) / elapsed if elapsed > 0 else 0.0
+    logging.info(
+        "Inserted {} questions in {:.2f}s ({:.0f} rows/s)".format(
+            len(questions), elapsed, rows_per_second
+        )
     )
+    return {"rows": len(questions), "seconds": elapsed, "rows_per_second": rows_per_second}
 
-    for element in data:
-        data_question = {
-            "id": element["ts"],
-            "question": element["text"][:10000],
-            "answer": element["response"]["text"][:10000],
-            "user_question": element["user"],
-            "user_answer": element["response"]["user"],
-            "related": str(",".join([item[0] for item in element["related"]][:10])),
-            "keywords": str(",".join(element["keywords"])),
-            "aux_keywords": str(",".join(element["aux_keywords"])),
-            "score": 0,
-        }
-        cursor.execute(add_question, data_question)
 
-    cnx.commit()
-    cursor.close()
-    cnx.close()
+def loadImportState():
+    try:
+        with open(IMPORT_STATE_FILE) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+
+
+def saveImportState(state):
+    temporary_file = IMPORT_STATE_FILE + ".tmp"
+    with open(temporary_file, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_file, IMPORT_STATE_FILE)
+
+
+def importRange(init_date, final_date):
+    """Fetches, enriches and upserts the questions asked between both dates.
+
+    Runs as a pull based stream: history pages are filtered and grouped into
+    IMPORT_BATCH_SIZE batches, and each batch is joined with its responses,
+    gets its keywords and is inserted before the next page is needed. Only the
+    (small) response lookup and one batch are held in memory.
+
+    Returns the ts of the oldest question still waiting for an answer, or None.
+    """
+    if len(synonym_cache) == 0:
+        loadSynonymCache()
+    with metrics.timed("import_stage", stage="responses"):
+        by_permalink, by_thread_ts = buildResponseLookup(
+            iterResponses(init_date, final_date)
+        )
+
+    oldest_pending = None
+    pool = newKeywordPool() if KEYWORD_WORKERS > 1 else None
+    try:
+        # Time spent waiting for history pages is the "questions" stage
+        for batch in metrics.timedIter(
+            iterBatches(iterQuestions(init_date, final_date), IMPORT_BATCH_SIZE),
+            "import_stage",
+            stage="questions",
+        ):
+            answered = []
+            with metrics.timed("import_stage", stage="join"):
+                for question in batch:
+                    response = findResponse(question, by_permalink, by_thread_ts)
+                    if response is not None:
+                        question["response"] = response
+                        answered.append(question)
+                    elif "subtype" not in question:
+                        ts = float(question["ts"])
+                        if oldest_pending is None or ts < oldest_pending:
+                            oldest_pending = ts
+            metrics.increment("import_questions_total", len(batch))
+            if not answered:
+                continue
+            with metrics.timed("import_stage", stage="keywords"):
+                enrichedData = extractKeywords(answered, pool=pool)
+                for question in enrichedData:
+                    question["keywords"] = [
+                        str(i) for i in question["keywords"] if isValidKeyword(str(i))
+                    ]
+            with metrics.timed("import_stage", stage="insert"):
+                insertData(enrichedData)
+            metrics.increment("import_answered_total", len(enrichedData))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    saveSynonymCache()
+    return oldest_pending
+
+
+def indexKeywords():
+    with database.connection() as cnx:
+        if not keyword_vocabulary.ensureTables(cnx, create=False):
+            # Creating the tables indexes every question already
+            keyword_vocabulary.ensureTables(cnx)
+            return
+        cursor = cnx.cursor()
+        keyword_vocabulary.indexAllQuestions(cursor)
+        cnx.commit()
+        cursor.close()
 
 
 # MAIN
 def importToDB():
-    day = datetime.datetime.now().day
-    month = datetime.datetime.now().month
-    year = datetime.datetime.now().year
+    """Imports everything since the watermark (the end of the last import).
+
+    The watermark stays on the oldest unanswered question of the window, for at
+    most IMPORT_PENDING_DAYS, so questions answered after a run are picked up
+    by the next one. The first run starts IMPORT_PENDING_DAYS ago.
+    """
+    state = loadImportState()
+    final_date = datetime.datetime.now()
+    if state.get("watermark") is not None:
+        init_date = datetime.datetime.fromtimestamp(state["watermark"])
+    else:
+        today = final_date.replace(hour=0, minute=0, second=0, microsecond=0)
+        init_date = today - datetime.timedelta(days=IMPORT_PENDING_DAYS)
+
+    with metrics.timed("import_run"):
+        oldest_pending = importRange(init_date, final_date)
+
+    watermark = final_date.timestamp()
+    pending_limit = watermark - IMPORT_PENDING_DAYS * 24 * 60 * 60
+    if oldest_pending is not None and oldest_pending > pending_limit:
+        watermark = oldest_pending
+    state["watermark"] = max(watermark, state.get("watermark") or 0)
+    saveImportState(state)
+
+
+def backfill(start_date, end_date, chunk_days=IMPORT_CHUNK_DAYS):
+    """Imports an arbitrary past range chunk by chunk.
+
+    Progress is checkpointed after every chunk, so calling it again with the
+    same range resumes after the last finished chunk. Backfills do not move the
+    watermark.
+    """
+    state = loadImportState()
+    progress = state.get("backfill")
+    if (
+        progress is None
+        or progress["start"] != start_date.timestamp()
+        or progress["end"] != end_date.timestamp()
+    ):
+        progress = {
+            "start": start_date.timestamp(),
+            "end": end_date.timestamp(),
+            "next": start_date.timestamp(),
+        }
 
-    final_date = datetime.datetime(int(year), month, day, 23, 59, 59, 999999)
-    init_date = datetime.datetime(int(year), month, day, 0, 0, 0) - datetime.timedelta(
-        days=7
+    chunk_start = datetime.datetime.fromtimestamp(progress["next"])
+    while chunk_start < end_date:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end_date)
+        logging.info(f"Backfilling {chunk_start} - {chunk_end}")
+        importRange(chunk_start, chunk_end)
+        progress["next"] = chunk_end.timestamp()
+        state["backfill"] = progress
+        saveImportState(state)
+        chunk_start = chunk_end
+
+    state.pop("backfill", None)
+    saveImportState(state)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SOS TS importer")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    provision_parser = subparsers.add_parser(
+        "provision", help="download the NLTK data used for keyword extraction"
     )
-
-    questions, responses = importData(init_date, final_date)
-    enrichedData = enrichData(questions, responses)
-    insertData(enrichedData)
+    provision_parser.add_argument(
+        "--dir",
+        default=None,
+        help="NLTK data directory (defaults to NLTK_DATA_DIR, then NLTK's own); "
+        "set NLTK_DATA_DIR to the same directory where the importer runs",
+    )
+    subparsers.add_parser("import", help="import everything since the last import")
+    backfill_parser = subparsers.add_parser(
+        "backfill", help="import a past date range in resumable chunks"
+    )
+    backfill_parser.add_argument("start", help="first day, YYYY-MM-DD")
+    backfill_parser.add_argument("end", help="last day, YYYY-MM-DD")
+    backfill_parser.add_argument("--chunk-days", type=int, default=IMPORT_CHUNK_DAYS)
+    subparsers.add_parser(
+        "index-keywords",
+        help="rebuild the keyword postings from the keyword columns of every question",
+    )
+    args = parser.parse_args()
+
+    if args.command == "provision":
+        missing = provisionNlpResources(args.dir)
+        if missing:
+            logging.error("Missing NLTK data: {}".format(", ".join(missing)))
+            sys.exit(1)
+    elif args.command == "backfill":
+        backfill(
+            datetime.datetime.strptime(args.start, "%Y-%m-%d"),
+            datetime.datetime.strptime(args.end, "%Y-%m-%d")
+            + datetime.timedelta(days=1),
+            args.chunk_days,
+        )
+    elif args.command == "index-keywords":
+        indexKeywords()
+    else:
+        importToDB()
@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Finished jobs remembered for the status endpoint
+JOB_HISTORY_SIZE = 100
+
+# A single worker: the import and the related recompute write the same table,
+# so jobs run strictly one after the other, in submission order
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+_jobs = OrderedDict()
+_lock = threading.Lock()
+
+
+def submit(name, steps, params=None):
+    """Queues a job made of (step name, callable) pairs run in order, and
+    returns its id. params describes what the steps were built with (JSON
+    friendly). If a job with the same name, steps and params is still waiting
+    its id is returned instead of queueing a duplicate."""
+    step_names = [step_name for step_name, step in steps]
+    params = params or {}
+    with _lock:
+        for job in _jobs.values():
+            if (
+                job["status"] == "queued"
+                and job["name"] == name
+                and job["steps"] == step_names
+                and job["params"] == params
+            ):
+                return job["id"]
+        job = {
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "params": params,
+            "status": "queued",
+            "steps": step_names,
+            "current_step": None,
+            "created": time.time(),
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        _jobs[job["id"]] = job
+        while len(_jobs) > JOB_HISTORY_SIZE:
+            oldest = next(iter(_jobs.values()))
+            if oldest["status"] in ("queued", "running"):
+                break
+            _jobs.popitem(last=False)
+    _executor.submit(_run, job, steps)
+    return job["id"]
+
+
+def _run(job, steps):
+    job["status"] = "running"
+    job["started"] = time.time()
+    try:
+        for step_name, step in steps:
+            job["current_step"] = step_name
+            step()
+        job["status"] = "done"
+    except Exception as err:
+        logging.exception(f"Job {job['name']} failed in step {job['current_step']}")
+        job["status"] = "failed"
+        job["error"] = str(err)
+    finally:
+        job["current_step"] = None
+        job["finished"] = time.time()
+
+
+def get(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
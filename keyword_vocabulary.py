@@ -0,0 +1,183 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+TEST_MODE = False
+# Allows us to access the .env file
+
+if TEST_MODE:
+    load_dotenv(".env.stage")
+else:
+    load_dotenv(".env.production")
+
+DATABASE_TABLE = os.getenv("DATABASE_TABLE")
+# keyword -> integer id, shared by every process writing questions
+VOCABULARY_TABLE = os.getenv(
+    "DATABASE_VOCABULARY_TABLE", "{}_keywords".format(DATABASE_TABLE)
+)
+# (question, keyword id) pairs of the keywords and aux_keywords columns
+POSTINGS_TABLE = os.getenv(
+    "DATABASE_POSTINGS_TABLE", "{}_keyword_postings".format(DATABASE_TABLE)
+)
+KEYWORD_MAX_LENGTH = 255
+# Values of the "field" column of the postings
+KEYWORDS_FIELD = 0
+AUX_KEYWORDS_FIELD = 1
+# Rows per statement when looking up keywords and writing postings
+VOCABULARY_BATCH_SIZE = 1000
+
+# In-process copy of the part of the vocabulary seen so far
+_ids = {}
+_lock = threading.Lock()
+_tables_ready = False
+
+
+def normalize(keyword):
+    return keyword.strip().lower()[:KEYWORD_MAX_LENGTH]
+
+
+def ensureTables(cnx, create=True):
+    """True when the vocabulary and postings tables exist. With create, missing
+    tables are created and the keywords of the questions already in the table
+    are indexed, which reads the whole table: request handlers pass
+    create=False and leave that to the import and related jobs."""
+    global _tables_ready
+    if _tables_ready:
+        return True
+    with _lock:
+        if _tables_ready:
+            return True
+        cursor = cnx.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s",
+            (POSTINGS_TABLE,),
+        )
+        exists = cursor.fetchall()[0][0] > 0
+        if not exists and create:
+            # Binary collation: keywords differing only in case or accents are
+            # different keywords
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS " + VOCABULARY_TABLE + " ("
+                "id INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+                "keyword VARCHAR(" + str(KEYWORD_MAX_LENGTH) + ") "
+                "CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, "
+                "UNIQUE KEY keyword (keyword))"
+            )
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS " + POSTINGS_TABLE + " ("
+                "question_id VARCHAR(32) NOT NULL, "
+                "field TINYINT UNSIGNED NOT NULL, "
+                "keyword_id INT UNSIGNED NOT NULL, "
+                "PRIMARY KEY (question_id, field, keyword_id), "
+                "KEY keyword_id (keyword_id))"
+            )
+            try:
+                indexAllQuestions(cursor)
+                cnx.commit()
+            except Exception:
+                # Ids seen in the rolled back transaction may not exist
+                _ids.clear()
+                raise
+            exists = True
+        cursor.close()
+        _tables_ready = exists
+        return exists
+
+
+def _lookup(cursor, keywords, found):
+    for start in range(0, len(keywords), VOCABULARY_BATCH_SIZE):
+        batch = keywords[start : start + VOCABULARY_BATCH_SIZE]
+        # A locking read sees the latest committed rows, not the transaction's
+        # snapshot, so keywords just added by other processes are found
+        cursor.execute(
+            "SELECT id, keyword FROM " + VOCABULARY_TABLE + " WHERE keyword IN ("
+            + ", ".join(["%s"] * len(batch))
+            + ") LOCK IN SHARE MODE",
+            batch,
+        )
+        for keyword_id, keyword in cursor.fetchall():
+            found[keyword] = keyword_id
+
+
+def keywordIds(cursor, keywords):
+    """keyword -> id for normalized keywords, adding the new ones to the
+    vocabulary in the caller's transaction. Only keywords this process has not
+    seen reach the database, and only ids that existed before the call are
+    remembered: the ones added here go away if the caller rolls back."""
+    missing = [keyword for keyword in set(keywords) if keyword not in _ids]
+    if not missing:
+        return {keyword: _ids[keyword] for keyword in keywords}
+    _lookup(cursor, missing, _ids)
+    missing = [keyword for keyword in missing if keyword not in _ids]
+    added = {}
+    if missing:
+        for start in range(0, len(missing), VOCABULARY_BATCH_SIZE):
+            batch = missing[start : start + VOCABULARY_BATCH_SIZE]
+            # IGNORE: another process may add the same keyword meanwhile
+            cursor.execute(
+                "INSERT IGNORE INTO " + VOCABULARY_TABLE + " (keyword) VALUES "
+                + ", ".join(["(%s)"] * len(batch)),
+                batch,
+            )
+        _lookup(cursor, missing, added)
+    return {
+        keyword: _ids[keyword] if keyword in _ids else added[keyword]
+        for keyword in keywords
+    }
+
+
+def writePostings(cursor, questions):
+    """Replaces the postings of questions, (id, keywords, aux_keywords) tuples.
+    Runs in the caller's transaction."""
+    if not questions:
+        return
+    encoded = []
+    for question_id, keywords, aux_keywords in questions:
+        for field, values in (
+            (KEYWORDS_FIELD, keywords),
+            (AUX_KEYWORDS_FIELD, aux_keywords),
+        ):
+            for keyword in {normalize(value) for value in values}:
+                if keyword:
+                    encoded.append((str(question_id), field, keyword))
+    ids = keywordIds(cursor, [keyword for question_id, field, keyword in encoded])
+
+    question_ids = [str(question[0]) for question in questions]
+    for start in range(0, len(question_ids), VOCABULARY_BATCH_SIZE):
+        batch = question_ids[start : start + VOCABULARY_BATCH_SIZE]
+        cursor.execute(
+            "DELETE FROM " + POSTINGS_TABLE + " WHERE question_id IN ("
+            + ", ".join(["%s"] * len(batch))
+            + ")",
+            batch,
+        )
+    for start in range(0, len(encoded), VOCABULARY_BATCH_SIZE):
+        batch = encoded[start : start + VOCABULARY_BATCH_SIZE]
+        cursor.execute(
+            "INSERT INTO " + POSTINGS_TABLE + " (question_id, field, keyword_id) VALUES "
+            + ", ".join(["(%s, %s, %s)"] * len(batch)),
+            [
+                value
+                for question_id, field, keyword in batch
+                for value in (question_id, field, ids[keyword])
+            ],
+        )
+
+
+def splitColumn(column):
+    return column.split(",") if column else []
+
+
+def indexAllQuestions(cursor):
+    # Postings of every question, from the comma joined keyword columns
+    cursor.execute("SELECT id, keywords, aux_keywords FROM " + DATABASE_TABLE)
+    rows = cursor.fetchall()
+    for start in range(0, len(rows), VOCABULARY_BATCH_SIZE):
+        writePostings(
+            cursor,
+            [
+                (row[0], splitColumn(row[1]), splitColumn(row[2]))
+                for row in rows[start : start + VOCABULARY_BATCH_SIZE]
+            ],
+        )
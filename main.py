@@ -1,4 +1,11 @@
+import asyncio
+import contextvars
+import functools
+import json
 import os
+from itertools import chain
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
 from slack_sdk import WebClient
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
@@ -6,12 +13,26 @@ import datetime
 import time
 from pydantic import BaseModel
 import mysql.connector
+from mysql.connector import errorcode
 import logging
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, Request, Response, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import importer
 import update_related
+import search_index
+import database
+import metrics
+import slack_pagination
+import message_cache
+import jobs
+import keyword_vocabulary
+import question_counter
+import question_ids
+import reaction_index
+from user_directory import UserDirectory
+from lru_cache import LRUCache
+from write_coalescer import WriteCoalescer
 from apscheduler.schedulers.background import BackgroundScheduler
 
 
@@ -21,6 +42,42 @@ headers = {
 
 # Additional configuration vars
 USERS_BATCH_SIZE = 100
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+# Question rows kept in memory for /v1/getRelatedQuestions
+ROW_CACHE_SIZE = 5000
+# Columns of the questions table, in "SELECT *" order
+QUESTION_COLUMNS = (
+    "id",
+    "question",
+    "answer",
+    "user_question",
+    "user_answer",
+    "related",
+    "keywords",
+    "aux_keywords",
+    "score",
+)
+# Rows or messages per chunk written by the NDJSON streaming mode
+STREAM_BATCH_SIZE = 100
+# Seconds before the cached workspace users are refreshed from Slack
+USER_DIRECTORY_TTL = 900
+# Seconds between checks of the cached question count against COUNT(*)
+QUESTION_COUNT_RECONCILE_INTERVAL = 600
+# Single creates arriving this many seconds apart share one INSERT and commit
+CREATE_COALESCE_WINDOW = 0.01
+# Rows per multi-row INSERT when creating questions
+CREATE_BATCH_SIZE = 500
+WORKSPACE_SNAPSHOT_FILE = "user_data/workspace"
+# Seconds after the end of a month before it is refetched in full and cached
+# for good, so late reactions and edits make it into the cache
+MONTH_CLOSE_GRACE = 3 * 24 * 60 * 60
+# Threads for blocking Slack calls and for blocking MySQL calls. They are kept
+# apart so slow Slack requests can never starve the database routes.
+SLACK_EXECUTOR_WORKERS = 16
+DB_EXECUTOR_WORKERS = database.DATABASE_POOL_SIZE
+# Request header asking for a Server-Timing breakdown in the response
+TIMING_REQUEST_HEADER = "x-request-timing"
 TEST_MODE = False
 origins = ["*"]
 
@@ -42,14 +99,17 @@ else:
 # env variables
 SLACK_APP_TOKEN = os.getenv("SLACK_APP_TOKEN")
 TOKEN_FOR_SEARCH = os.getenv("TOKEN_FOR_SEARCH")
-DATABASE_DIRECTION = os.getenv("DATABASE_DIRECTION")
-DATABASE_USER = os.getenv("DATABASE_USER")
-DATABASE_PASSWORD = os.getenv("DATABSE_PASSWORD")
-DATABASE_NAME = os.getenv("DATABASE_NAME")
 DATABASE_TABLE = os.getenv("DATABASE_TABLE")
 
 
 client = WebClient(SLACK_APP_TOKEN)
+slack_executor = ThreadPoolExecutor(
+    max_workers=SLACK_EXECUTOR_WORKERS, thread_name_prefix="slack"
+)
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+)
+row_cache = LRUCache(ROW_CACHE_SIZE)
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -60,6 +120,35 @@ app.add_middleware(
 )
 
 
+async def runIn(executor, function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Runs in a copy of the request context so spans reach the request's timings
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        executor, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+
+@app.middleware("http")
+async def recordRequestMetrics(request: Request, call_next):
+    timings = None
+    if request.headers.get(TIMING_REQUEST_HEADER):
+        timings = metrics.collectRequestTimings()
+    started = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - started
+    endpoint = request.scope.get("endpoint")
+    handler = endpoint.__name__ if endpoint is not None else "unmatched"
+    metrics.observe("http_request_seconds", elapsed, handler=handler)
+    metrics.increment(
+        "http_requests_total", handler=handler, status=response.status_code
+    )
+    if timings is not None:
+        timings.append(("total", elapsed))
+        response.headers["Server-Timing"] = metrics.serverTiming(timings)
+    return response
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     exc_str = f"{exc}".replace("\n", " ").replace("   ", " ")
@@ -70,75 +159,210 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 
-def formatWorkspaceUsers(users):
-    cleanedUsers = {}
-    for user in users:
-        cleanedUsers[user["id"]] = user
-    return cleanedUsers
-
-
 def getUsersInChannelFromSlack(client, channelID):
     users_in_channel = []
-    all_users_fetched = False
-
-    # Cursor needed to iter over the requests (pagination)
-    users_cursor = ""
-
-    # Get all users id that pertain to the channel
-    while all_users_fetched is False:
-        users_retrieved = client.conversations_members(
-            channel=channelID, limit=USERS_BATCH_SIZE, cursor=users_cursor
-        ).data
-
+    for users_retrieved in slack_pagination.paginateCursor(
+        client.conversations_members, channel=channelID, limit=USERS_BATCH_SIZE
+    ):
         users_in_channel += users_retrieved["members"]
 
-        all_users_fetched = not (
-            users_retrieved["response_metadata"]
-            and users_retrieved["response_metadata"]["next_cursor"]
-        )
-        users_cursor = users_retrieved["response_metadata"]["next_cursor"]
-
     # [id_user_1, id_user_2, ... ]
     return users_in_channel
 
 
 @app.get("/")
-def testMessage():
+async def testMessage():
     return True
 
 
-@app.get("/v1/getQuestions/{query}")
-def getMessages(query):
-    cnx = mysql.connector.connect(
-        user=DATABASE_NAME,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_DIRECTION,
-        database=DATABASE_NAME,
+@app.get("/metrics", response_class=PlainTextResponse)
+async def getMetrics():
+    return metrics.render()
+
+
+def getAllQuestionsFromDB():
+    with database.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute("SELECT * FROM " + DATABASE_TABLE)
+        myresult = cursor.fetchall()
+        cursor.close()
+    return myresult
+
+
+def refreshSearchIndex():
+    try:
+        search_index.rebuild(getAllQuestionsFromDB())
+    except mysql.connector.Error as err:
+        # Searches keep falling back to the database until the next refresh works
+        logging.error(f"Could not load the search index: {err}")
+
+
+@app.on_event("startup")
+def loadSearchIndex():
+    refreshSearchIndex()
+
+
+@app.on_event("startup")
+def loadQuestionCount():
+    try:
+        reconcileQuestionCount()
+    except mysql.connector.Error as err:
+        # The endpoint counts on demand until this works
+        logging.error(f"Could not count the questions: {err}")
+
+
+@app.on_event("startup")
+def loadUserDirectory():
+    # Start warm from the last snapshot, then catch up with Slack in the background
+    user_directory.loadSnapshot()
+    user_directory.refreshInBackground()
+
+
+def ndjsonResponse(batches, executor, headers=None):
+    """Streams an iterator of row lists as newline delimited JSON. Each batch
+    is pulled on the executor, so a batch reaches the client as soon as its
+    Slack page or cursor fetch arrives."""
+
+    async def lines():
+        iterator = iter(batches)
+        try:
+            while True:
+                batch = await runIn(executor, next, iterator, None)
+                if batch is None:
+                    break
+                yield "".join(json.dumps(row, default=str) + "\n" for row in batch)
+        finally:
+            if hasattr(iterator, "close"):
+                await runIn(executor, iterator.close)
+
+    return StreamingResponse(
+        lines(), media_type="application/x-ndjson", headers=headers
     )
-    cursor = cnx.cursor()
 
-    substring_query = (
-        "SELECT * FROM " + DATABASE_TABLE + " WHERE "
-        "LOWER(question) LIKE %(search_for)s OR "
-        "LOWER(answer) LIKE %(search_for)s OR "
+
+def inBatches(rows):
+    for start in range(0, len(rows), STREAM_BATCH_SIZE):
+        yield rows[start : start + STREAM_BATCH_SIZE]
+
+
+@app.get("/v1/getQuestions/{query}")
+async def getMessages(
+    query,
+    response: Response,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    view: str = "full",
+    stream: bool = False,
+):
+    # Streaming has constant memory, so it may return every match
+    if limit is None:
+        limit = None if stream else SEARCH_DEFAULT_LIMIT
+    elif not stream:
+        limit = min(max(limit, 1), SEARCH_MAX_LIMIT)
+    offset = max(offset, 0)
+
+    if search_index.isLoaded():
+        # Ranking is CPU bound and holds the index lock, keep it off the event loop
+        total, rows = await runIn(
+            db_executor, searchQuestionsInIndex, query, limit, offset, view
+        )
+        if stream:
+            return ndjsonResponse(
+                inBatches(rows), db_executor, {"X-Total-Count": str(total)}
+            )
+        response.headers["X-Total-Count"] = str(total)
+        return rows
+
+    if stream:
+        return ndjsonResponse(
+            iterQuestionsInDB(query, limit, offset, view), db_executor
+        )
+    return await runIn(db_executor, searchQuestionsInDB, query, limit, offset, view)
+
+
+def searchQuestionsInIndex(query, limit, offset, view):
+    with metrics.timed("search_query"):
+        total, ranked = search_index.search(query, limit=limit, offset=offset)
+    if view == "snippet":
+        rows = [
+            {
+                "id": row[0],
+                "snippet": search_index.snippet(row, query),
+                "score": round(score, 4),
+            }
+            for score, row in ranked
+        ]
+    else:
+        rows = [row for score, row in ranked]
+    return total, rows
+
+
+def searchQuestionsInDB(query, limit, offset, view):
+    return list(chain.from_iterable(iterQuestionsInDB(query, limit, offset, view)))
+
+
+def iterQuestionsInDB(query, limit, offset, view):
+    if view == "snippet":
+        columns = "id, LEFT(question, " + str(search_index.SNIPPET_LENGTH) + ")"
+    else:
+        columns = "*"
+    # Keywords are matched once in the (lowercase, deduplicated) vocabulary
+    # instead of in the keyword columns of every row. Until the import has
+    # created the vocabulary the columns are searched.
+    keyword_vocabulary_query = (
+        "id IN (SELECT p.question_id FROM " + keyword_vocabulary.POSTINGS_TABLE + " p "
+        "JOIN " + keyword_vocabulary.VOCABULARY_TABLE + " v ON v.id = p.keyword_id "
+        "WHERE v.keyword LIKE %(search_for_keyword)s) "
+    )
+    keyword_columns_query = (
         "LOWER(keywords) LIKE %(search_for)s OR "
-        "LOWER(aux_keywords) LIKE %(search_for)s"
+        "LOWER(aux_keywords) LIKE %(search_for)s "
     )
-    cursor.execute(substring_query, {"search_for": "%" + query + "%"})
-    myresult = cursor.fetchall()
-    cursor.close()
-    cnx.close()
-    return myresult
+    if limit is None:
+        # MySQL has no OFFSET without LIMIT, this is its documented "no limit"
+        limit = 18446744073709551615
+    with database.connection() as cnx:
+        # Never creates or indexes the tables from a request
+        has_vocabulary = keyword_vocabulary.ensureTables(cnx, create=False)
+        substring_query = (
+            "SELECT " + columns + " FROM " + DATABASE_TABLE + " WHERE "
+            "LOWER(question) LIKE %(search_for)s OR "
+            "LOWER(answer) LIKE %(search_for)s OR "
+            + (keyword_vocabulary_query if has_vocabulary else keyword_columns_query)
+            # A stable order, so successive pages never repeat or skip rows
+            + "ORDER BY id LIMIT %(limit)s OFFSET %(offset)s"
+        )
+        cursor = cnx.cursor()
+        cursor.execute(
+            substring_query,
+            {
+                "search_for": "%" + query + "%",
+                "search_for_keyword": "%" + keyword_vocabulary.normalize(query) + "%",
+                "limit": limit,
+                "offset": offset,
+            },
+        )
+        while True:
+            myresult = cursor.fetchmany(STREAM_BATCH_SIZE)
+            if not myresult:
+                break
+            if view == "snippet":
+                myresult = [
+                    {"id": row[0], "snippet": row[1], "score": None}
+                    for row in myresult
+                ]
+            yield myresult
+        cursor.close()
 
 
 @app.get("/v1/users/{channelID}")
-def getUsersInChannel(channelID):
-    temp_workspace_users = getUsersInWorkspace(client)
-    workspace_users = formatWorkspaceUsers(temp_workspace_users)
-    temp_channel_users = getUsersInChannelFromSlack(client, channelID)
-    channel_users = [
-        workspace_users[channel_user] for channel_user in temp_channel_users
-    ]
+async def getUsersInChannel(channelID):
+    temp_channel_users = await runIn(
+        slack_executor, getUsersInChannelFromSlack, client, channelID
+    )
+    channel_users = await runIn(
+        slack_executor, user_directory.getUsers, temp_channel_users
+    )
     data = {"channel": channel_users}
     return data
 
@@ -154,162 +378,332 @@ class ItemRelated(BaseModel):
 
 
 @app.get("/v1/totalQuestionsAvailable")
-def getTotalQuestions():
-    get_query = "SELECT COUNT(*) FROM " + DATABASE_TABLE
-    cnx = mysql.connector.connect(
-        user=DATABASE_NAME,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_DIRECTION,
-        database=DATABASE_NAME,
-    )
+async def getTotalQuestions():
+    count = question_counter.getCount()
+    if count is None:
+        count = await runIn(db_executor, reconcileQuestionCount)
+    return count
+
+
+def reconcileQuestionCount():
+    count = countQuestionsInDB()
+    question_counter.setCount(count)
+    return count
 
-    cursor = cnx.cursor()
-    cursor.execute(get_query)
-    myresult = cursor.fetchall()
-    cursor.close()
-    cnx.close()
+
+def countQuestionsInDB():
+    get_query = "SELECT COUNT(*) FROM " + DATABASE_TABLE
+    with database.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(get_query)
+        myresult = cursor.fetchall()
+        cursor.close()
 
     return myresult[0][0]
 
 
-@app.get("/v1/updateDatabase")
-def updateDatabase():
+def afterDatabaseWrite():
+    # The importer and the related job rewrite rows behind our back
+    row_cache.clear()
+    refreshSearchIndex()
+
+
+def runImport():
     importer.importToDB()
-    return 200
+    afterDatabaseWrite()
+
+
+def runRelatedUpdate(full=False):
+    update_related.updateRelatedQuestions(incremental=not full)
+    afterDatabaseWrite()
+
+
+def runBackfill(start_date, end_date):
+    importer.backfill(start_date, end_date)
+    afterDatabaseWrite()
+
+
+@app.get("/v1/updateDatabase")
+async def updateDatabase(related: bool = True):
+    # The related recompute is chained after the import in the same job, so it
+    # always sees the new questions
+    steps = [("import", runImport)]
+    if related:
+        steps.append(("related", runRelatedUpdate))
+    job_id = jobs.submit("updateDatabase", steps, {"related": related})
+    return {"status": 200, "job_id": job_id}
 
 
 @app.get("/v1/updateRelatedDatabase")
-def updateRelatedDatabase():
-    # Prevent race condition
-    time.sleep(300)
-    update_related.updateRelatedQuestions()
-    return 200
+async def updateRelatedDatabase(full: bool = False):
+    job_id = jobs.submit(
+        "updateRelatedDatabase",
+        [("related", functools.partial(runRelatedUpdate, full=full))],
+        {"full": full},
+    )
+    return {"status": 200, "job_id": job_id}
+
+
+@app.get("/v1/backfillDatabase")
+async def backfillDatabase(start: datetime.date, end: datetime.date):
+    # Inclusive range of days; re-sending the same range resumes it
+    start_date = datetime.datetime.combine(start, datetime.time())
+    end_date = datetime.datetime.combine(end, datetime.time()) + datetime.timedelta(
+        days=1
+    )
+    job_id = jobs.submit(
+        "backfillDatabase",
+        [
+            ("backfill", functools.partial(runBackfill, start_date, end_date)),
+            ("related", runRelatedUpdate),
+        ],
+        {"start": start.isoformat(), "end": end.isoformat()},
+    )
+    return {"status": 200, "job_id": job_id}
+
+
+@app.get("/v1/jobs/{job_id}")
+async def getJobStatus(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(
+            content={"status": 404, "message": "Unknown job"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    return job
+
+
+def scheduleWeeklyUpdate():
+    jobs.submit(
+        "updateDatabase",
+        [("import", runImport), ("related", runRelatedUpdate)],
+        {"related": True},
+    )
 
 
 @app.post("/v1/getRelatedQuestions")
-def getRelatedQuestions(item: ItemRelated):
+async def getRelatedQuestions(item: ItemRelated, fields: Optional[str] = None):
     ids = item.ids.split(",")
     for index, id in enumerate(ids):
         ids[index] = str(id)
-    ids = tuple(ids)
-    cnx = mysql.connector.connect(
-        user=DATABASE_NAME,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_DIRECTION,
-        database=DATABASE_NAME,
-    )
-    cursor = cnx.cursor()
-    statement = "SELECT * FROM {0} WHERE id IN ({1})".format(
-        DATABASE_TABLE, ", ".join(["%s"] * len(ids))
-    )
+    myresult = await runIn(db_executor, getQuestionsByIds, tuple(ids))
+    return {"status": 200, "related": projectRows(myresult, fields)}
+
+
+@app.post("/v1/getRelatedQuestionsBulk")
+async def getRelatedQuestionsBulk(item: ItemRelated, fields: Optional[str] = None):
+    # Related questions of many questions at once: {question id: [related rows]}
+    ids = [str(id) for id in item.ids.split(",") if id]
+    related = await runIn(db_executor, getRelatedOfQuestions, ids)
+    return {
+        "status": 200,
+        "related": {id: projectRows(rows, fields) for id, rows in related.items()},
+    }
 
-    cursor.execute(statement, tuple(ids))
-    myresult = cursor.fetchall()
-    cursor.close()
-    cnx.close()
-    return {"status": 200, "related": myresult}
 
+def projectRows(rows, fields):
+    # Only the requested columns (e.g. fields=id,question), as dicts
+    if not fields:
+        return rows
+    columns = [field for field in fields.split(",") if field in QUESTION_COLUMNS]
+    positions = [QUESTION_COLUMNS.index(column) for column in columns]
+    return [
+        {column: row[position] for column, position in zip(columns, positions)}
+        for row in rows
+    ]
 
-@app.post("/v1/createQuestion")
-def sendMessageToChannel(item: Item):
-    try:
-        add_question = (
-            "INSERT INTO " + DATABASE_TABLE + " "
-            "(id, question, answer, user_question,user_answer,related,keywords,aux_keywords,score) "
-            "VALUES (%(id)s, %(question)s, %(answer)s, %(user_question)s,%(user_answer)s,"
-            "%(related)s,%(keywords)s,%(aux_keywords)s,%(score)s)"
-        )
 
-        cnx = mysql.connector.connect(
-            user=DATABASE_NAME,
-            password=DATABASE_PASSWORD,
-            host=DATABASE_DIRECTION,
-            database=DATABASE_NAME,
-        )
+def getQuestionsByIds(ids):
+    # Rows in the order asked, from the hot row cache when possible; all the
+    # misses are read with a single query
+    rows = {}
+    missing = []
+    for id in ids:
+        row = row_cache.get(id)
+        if row is None:
+            missing.append(id)
+        else:
+            rows[id] = row
 
-        cursor = cnx.cursor()
+    if missing:
+        statement = "SELECT * FROM {0} WHERE id IN ({1})".format(
+            DATABASE_TABLE, ", ".join(["%s"] * len(missing))
+        )
+        with database.connection() as cnx:
+            cursor = cnx.cursor()
+            cursor.execute(statement, tuple(missing))
+            myresult = cursor.fetchall()
+            cursor.close()
+        for row in myresult:
+            rows[str(row[0])] = row
+            row_cache.put(str(row[0]), row)
+
+    return [rows[id] for id in ids if id in rows]
+
+
+def getRelatedOfQuestions(ids):
+    questions = getQuestionsByIds(ids)
+    related_ids = {
+        str(question[0]): [id for id in (question[5] or "").split(",") if id]
+        for question in questions
+    }
+    related_rows = {
+        str(row[0]): row
+        for row in getQuestionsByIds(
+            list(dict.fromkeys(chain.from_iterable(related_ids.values())))
+        )
+    }
+    return {
+        id: [
+            related_rows[related]
+            for related in related_ids.get(id, [])
+            if related in related_rows
+        ]
+        for id in ids
+    }
 
-        data_question = {
-            "id": time.time(),
-            "question": item.question,
-            "answer": item.answer,
-            "user_question": item.user,
-            "user_answer": item.user,
-            "related": "",
-            "keywords": "",
-            "aux_keywords": "",
-            "score": 0,
-        }
 
-        cursor.execute(add_question, data_question)
-        cnx.commit()
-        cursor.close()
-        cnx.close()
+@app.post("/v1/createQuestion")
+async def sendMessageToChannel(item: Item):
+    try:
+        await asyncio.wrap_future(question_writer.submit(item))
         return 200
     except mysql.connector.Error as err:
         print(err)
         return 500
 
 
+@app.post("/v1/createQuestions")
+async def sendMessagesToChannel(items: List[Item]):
+    try:
+        ids = await runIn(db_executor, createQuestions, items)
+        return {"status": 200, "ids": ids}
+    except mysql.connector.Error as err:
+        print(err)
+        return {"status": 500, "ids": []}
+
+
+def questionRows(items, ids):
+    return [
+        (id, item.question, item.answer, item.user, item.user, "", "", "", 0)
+        for id, item in zip(ids, items)
+    ]
+
+
+def insertQuestionRows(rows):
+    with database.connection() as cnx:
+        cursor = cnx.cursor()
+        for start in range(0, len(rows), CREATE_BATCH_SIZE):
+            chunk = rows[start : start + CREATE_BATCH_SIZE]
+            cursor.execute(
+                "INSERT INTO " + DATABASE_TABLE + " "
+                "(id, question, answer, user_question,user_answer,related,keywords,aux_keywords,score) "
+                "VALUES " + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(chunk)),
+                [value for row in chunk for value in row],
+            )
+        # All the rows are created in one transaction
+        cnx.commit()
+        cursor.close()
+
+
+def createQuestions(items):
+    """Inserts the questions in one transaction and returns their new ids."""
+    ids = question_ids.newIds(len(items))
+    rows = questionRows(items, ids)
+    try:
+        insertQuestionRows(rows)
+    except mysql.connector.IntegrityError as err:
+        # Only another process handing out the same ids can collide: retry once
+        # with later ones
+        if err.errno != errorcode.ER_DUP_ENTRY:
+            raise
+        ids = question_ids.newIds(len(items))
+        rows = questionRows(items, ids)
+        insertQuestionRows(rows)
+
+    for id in ids:
+        row_cache.pop(id)
+    question_counter.addCount(len(rows))
+    search_index.addRows(rows)
+    metrics.increment("questions_created_total", len(rows))
+    metrics.observe("question_write_batch_size", len(rows))
+    return ids
+
+
+question_writer = WriteCoalescer(
+    createQuestions, CREATE_COALESCE_WINDOW, CREATE_BATCH_SIZE, name="question-writer"
+)
+
+
 @app.get("/v1/messages/{channelID}/{month}/{year}")
-def getMessagesInChannel(channelID, month, year, reactions=""):
-    allMessages = getAllMessagesFromTheChannel(channelID, month, year)
-    # messages_array,messages_totals=getMessagesWithSpecificReactions(allMessages)
+async def getMessagesInChannel(channelID, month, year, reactions="", stream: bool = False):
+    """reactions: comma separated names, or "*" for all, adds the legacy
+    "all_messages_:<name>:" lists and "all_messages_:<name>:_total" totals."""
+    if stream:
+        return ndjsonResponse(
+            iterMessagesFromTheChannel(channelID, month, year), slack_executor
+        )
+    allMessages, index = await runIn(
+        slack_executor, getMessagesAndReactions, channelID, month, year
+    )
     messages_array = {}
     messages_array["all_messages"] = allMessages
-    # messages_array.update(messages_totals)
+    if reactions:
+        names = index.names if reactions == "*" else reactions.split(",")
+        messages_by_reaction, messages_totals = getMessagesWithSpecificReactions(
+            allMessages, index, names
+        )
+        messages_array.update(messages_by_reaction)
+        messages_array.update(messages_totals)
 
     return messages_array
 
 
-def getMessagesWithSpecificReactions(allMessages):
+@app.get("/v1/reactions/{channelID}/{month}/{year}")
+async def getReactionsInChannel(
+    channelID, month, year, reaction="", match="any", view="full"
+):
+    """Totals per reaction of a channel month. With reaction (comma separated
+    names) also the messages having any (or, with match=all, every) of them;
+    view=ids lists only their ts."""
+    allMessages, index = await runIn(
+        slack_executor, getMessagesAndReactions, channelID, month, year
+    )
+    names = [name for name in reaction.split(",") if name]
+    data = {"totals": index.summary(names or None), "messages_total": len(allMessages)}
+    if names:
+        positions = index.matching(names, match_all=match == "all")
+        if view == "ids":
+            data["messages"] = [allMessages[position]["ts"] for position in positions]
+        else:
+            data["messages"] = [allMessages[position] for position in positions]
+    return data
+
+
+def getMessagesWithSpecificReactions(allMessages, index, names):
     messages_in_channel = {}
     messages_in_channel_totals = {}
-    for message in allMessages:
-        if "reactions" in message:
-            for reaction in message["reactions"]:
-                if ("all_messages_:" + reaction["name"] + ":") in messages_in_channel:
-                    messages_in_channel[
-                        "all_messages_:" + reaction["name"] + ":"
-                    ].append(message)
-                    messages_in_channel_totals[
-                        "all_messages_:" + reaction["name"] + ":" + "_total"
-                    ] += reaction["count"]
-                else:
-                    messages_in_channel["all_messages_:" + reaction["name"] + ":"] = [
-                        message
-                    ]
-                    messages_in_channel_totals[
-                        "all_messages_:" + reaction["name"] + ":" + "_total"
-                    ] = reaction["count"]
+    for name, totals in index.summary(names).items():
+        messages_in_channel["all_messages_:" + name + ":"] = [
+            allMessages[position] for position in index.positionsOf(name)
+        ]
+        messages_in_channel_totals["all_messages_:" + name + ":_total"] = totals["total"]
     return messages_in_channel, messages_in_channel_totals
 
 
 def getUsersInWorkspace(client):
     users_in_workspace = []
     users_batch = 200
-    all_users_fetched = False
-
-    # Cursor needed to iter over the requests (pagination)
-    users_cursor = ""
-
-    # Get all users id that pertain to the channel
-    while all_users_fetched is False:
-        users_retrieved = client.users_list(
-            limit=users_batch, cursor=users_cursor, include_locals=True
-        ).data
+    for users_retrieved in slack_pagination.paginateCursor(
+        client.users_list, limit=users_batch, include_locals=True
+    ):
         users_in_workspace += users_retrieved["members"]
-        all_users_fetched = not (
-            users_retrieved["response_metadata"]
-            and users_retrieved["response_metadata"]["next_cursor"]
-        )
-        users_cursor = users_retrieved["response_metadata"]["next_cursor"]
 
     # [{user_1}, {user_2}, ... ]
     return users_in_workspace
 
 
-def getAllMessagesFromTheChannel(channel_id, month, year):
+def getMonthBounds(month, year):
     months = [
         "",
         "january",
@@ -349,36 +743,100 @@ def getAllMessagesFromTheChannel(channel_id, month, year):
     # Generate the timestamps that are required to make the request in the Slack API
     oldest = time.mktime(oldest.timetuple())
     latest = time.mktime(latest.timetuple())
-    # Prints to debug (We can use logger or others later).
-    # print("Tomorrow timestamp: "+str(tomorrow))
-    # print("Month ago  timestamp: "+str(month_ago))
-
-    # Request to the Slack API
-    all_messages = []
-    cursor_id = None
-    intitial_loop = True
-    while cursor_id is not None or intitial_loop:
-        intitial_loop = False
-        result = client.conversations_history(
-            channel=channel_id,
-            latest=latest,
-            oldest=oldest,
-            inclusive=True,
-            include_all_metadata=True,
-            limit=500,
-            cursor=cursor_id,
-        )
-        all_messages += result.data["messages"]
-        if result.data["has_more"] is True:
-            cursor_id = result.data["response_metadata"]["next_cursor"]
+    return oldest, latest, months.index(month), int(year)
+
+
+def iterMessagesFromTheChannel(channel_id, month, year):
+    # Streaming variant: yields the month page by page and keeps nothing. Closed
+    # months still come from the cache, the current one straight from Slack.
+    oldest, latest, month_number, year = getMonthBounds(month, year)
+    cached = message_cache.load(channel_id, year, month_number)
+    if cached is not None and cached["closed"]:
+        yield from inBatches(cached["messages"])
+        return
+    yield from iterChannelHistory(channel_id, oldest, latest)
+
+
+def getChannelMonth(channel_id, month, year):
+    """Message cache entry of a channel month, fetching what is missing."""
+    oldest, latest, month_number, year = getMonthBounds(month, year)
+
+    # Closed months never change and are served from the cache. An open month
+    # only asks Slack for what is newer than the last cached message, which
+    # misses reactions, edits and deletions on older ones: when it closes,
+    # MONTH_CLOSE_GRACE after its end, it is fetched in full one last time.
+    with message_cache.monthLock(channel_id, year, month_number):
+        cached = message_cache.load(channel_id, year, month_number)
+        if cached is not None and cached["closed"]:
+            return (channel_id, year, month_number), cached
+
+        closed = latest + MONTH_CLOSE_GRACE < time.time()
+        if not closed and cached is not None and cached["newest_ts"] is not None:
+            new_messages = getChannelHistory(
+                channel_id, cached["newest_ts"], latest, inclusive=False
+            )
+            if not new_messages:
+                # Nothing new: no index rebuild and no rewrite of the month file
+                return (channel_id, year, month_number), cached
+            all_messages = message_cache.merge(cached["messages"], new_messages)
         else:
-            cursor_id = None
-    return all_messages
+            all_messages = getChannelHistory(channel_id, oldest, latest)
+
+        # The reaction index is built once here, when the messages change
+        with metrics.timed("reaction_index_build"):
+            reactions = reaction_index.ReactionIndex.build(all_messages)
+        entry = {
+            "messages": all_messages,
+            "newest_ts": message_cache.newestTs(all_messages),
+            "closed": closed,
+            "reactions": reactions.toDict(),
+            # Changes on every save, full refetches included, so the reaction
+            # index kept in memory for the month is never served stale
+            "revision": time.time_ns(),
+        }
+        message_cache.save(channel_id, year, month_number, entry)
+    return (channel_id, year, month_number), entry
+
+
+def getMessagesAndReactions(channel_id, month, year):
+    key, entry = getChannelMonth(channel_id, month, year)
+    index_key = key + (entry.get("revision"),)
+    return entry["messages"], reaction_index.forMonth(index_key, entry)
 
 
+def iterChannelHistory(channel_id, oldest, latest, inclusive=True):
+    # Request to the Slack API, one list of messages per page
+    for result in slack_pagination.paginateCursor(
+        client.conversations_history,
+        channel=channel_id,
+        latest=latest,
+        oldest=oldest,
+        inclusive=inclusive,
+        include_all_metadata=True,
+        limit=500,
+    ):
+        yield result["messages"]
+
+
+def getChannelHistory(channel_id, oldest, latest, inclusive=True):
+    return list(
+        chain.from_iterable(iterChannelHistory(channel_id, oldest, latest, inclusive))
+    )
+
+
+user_directory = UserDirectory(
+    lambda: getUsersInWorkspace(client),
+    lambda user_id: slack_pagination.callSlack(client.users_info, user=user_id)["user"],
+    USER_DIRECTORY_TTL,
+    WORKSPACE_SNAPSHOT_FILE,
+)
+
 sched = BackgroundScheduler(daemon=True)
-sched.add_job(updateDatabase,'cron',week='*')
-sched.add_job(updateRelatedDatabase,'cron',week='*')
+sched.add_job(scheduleWeeklyUpdate, 'cron', week='*')
+sched.add_job(user_directory.refresh, 'interval', seconds=USER_DIRECTORY_TTL)
+sched.add_job(
+    reconcileQuestionCount, 'interval', seconds=QUESTION_COUNT_RECONCILE_INTERVAL
+)
 sched.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import threading
+from collections import defaultdict
+from lru_cache import LRUCache
+
+MESSAGE_CACHE_DIR = "user_data/messages"
+# Closed months kept decompressed in memory
+MEMORY_CACHE_SIZE = 32
+
+_memory = LRUCache(MEMORY_CACHE_SIZE)
+_month_locks = defaultdict(threading.Lock)
+_month_locks_lock = threading.Lock()
+
+
+def cachePath(channel_id, year, month_number):
+    return os.path.join(
+        MESSAGE_CACHE_DIR, channel_id, "{}-{:02d}.json.gz".format(year, month_number)
+    )
+
+
+def monthLock(channel_id, year, month_number):
+    # One fetch per channel/month at a time, concurrent reloads wait for it
+    with _month_locks_lock:
+        return _month_locks[(channel_id, year, month_number)]
+
+
+def load(channel_id, year, month_number):
+    """Cached {"messages", "newest_ts", "closed"} entry of a month, or None."""
+    key = (channel_id, year, month_number)
+    entry = _memory.get(key)
+    if entry is not None:
+        return entry
+    try:
+        with gzip.open(cachePath(channel_id, year, month_number), "rt") as cache_file:
+            entry = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    if entry["closed"]:
+        _memory.put(key, entry)
+    return entry
+
+
+def save(channel_id, year, month_number, entry):
+    path = cachePath(channel_id, year, month_number)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_file = path + ".tmp"
+    with gzip.open(temporary_file, "wt") as cache_file:
+        json.dump(entry, cache_file, separators=(",", ":"))
+    os.replace(temporary_file, path)
+    if entry["closed"]:
+        _memory.put((channel_id, year, month_number), entry)
+
+
+def merge(cached_messages, new_messages):
+    # conversations.history lists newest first; keep that order and drop repeats
+    by_ts = {message["ts"]: message for message in cached_messages}
+    for message in new_messages:
+        by_ts[message["ts"]] = message
+    return sorted(by_ts.values(), key=lambda message: float(message["ts"]), reverse=True)
+
+
+def newestTs(messages):
+    return max((message["ts"] for message in messages), key=float, default=None)
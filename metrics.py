@@ -0,0 +1,132 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_summaries = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def setGauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    # Summaries keep count, sum and max, which is enough for rates and averages
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            _summaries[key] = [1, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            if value > summary[2]:
+                summary[2] = value
+
+
+# Spans of the current request, only set when the client asked for them
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def timed(name, **labels):
+    """Observes the duration of the block as <name>_seconds, and adds it to the
+    current request's timings when those are being collected."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(name + "_seconds", elapsed, **labels)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def timedIter(iterable, name, **labels):
+    # Times every pull from a generator, e.g. the Slack pages of a stream
+    iterator = iter(iterable)
+    while True:
+        with timed(name, **labels):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def collectRequestTimings():
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+def serverTiming(timings):
+    """Server-Timing header value, durations of the same span added up."""
+    totals = {}
+    for name, elapsed in timings:
+        count, total = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, total + elapsed)
+    return ", ".join(
+        '{};dur={:.2f};desc="{} calls"'.format(name, total * 1000, count)
+        for name, (count, total) in totals.items()
+    )
+
+
+def _formatLabels(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in labels
+        )
+        + "}"
+    )
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        summaries = sorted((key, list(value)) for key, value in _summaries.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append("# TYPE {} counter".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, _formatLabels(labels), value))
+    for (name, labels), value in gauges:
+        if name not in typed:
+            lines.append("# TYPE {} gauge".format(name))
+            typed.add(name)
+        lines.append("{}{} {}".format(name, _formatLabels(labels), value))
+    for (name, labels), (count, total, maximum) in summaries:
+        if name not in typed:
+            lines.append("# TYPE {} summary".format(name))
+            typed.add(name)
+        lines.append("{}_count{} {}".format(name, _formatLabels(labels), count))
+        lines.append("{}_sum{} {}".format(name, _formatLabels(labels), total))
+        lines.append(
+            "{}{} {}".format(name, _formatLabels(labels, [("quantile", "1")]), maximum)
+        )
+    return "\n".join(lines) + "\n"
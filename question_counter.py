@@ -0,0 +1,23 @@
+import threading
+
+# Number of rows in the questions table, kept by the code that inserts them and
+# reconciled against COUNT(*) from time to time. None until first set.
+_lock = threading.Lock()
+_count = None
+
+
+def getCount():
+    return _count
+
+
+def setCount(value):
+    global _count
+    with _lock:
+        _count = value
+
+
+def addCount(delta):
+    global _count
+    with _lock:
+        if _count is not None:
+            _count += delta
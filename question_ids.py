@@ -0,0 +1,19 @@
+import threading
+import time
+
+# Ids of created questions use the Slack ts format ("<seconds>.<microseconds>")
+# of the imported ones. Each id is at least one microsecond after the previous
+# one, so ids handed out by this process never repeat and always increase.
+_lock = threading.Lock()
+_last = 0
+
+
+def newIds(count):
+    global _last
+    with _lock:
+        first = max(time.time_ns() // 1000, _last + 1)
+        _last = first + count - 1
+    return [
+        "{}.{:06d}".format(micros // 1000000, micros % 1000000)
+        for micros in range(first, first + count)
+    ]
@@ -0,0 +1,115 @@
+from array import array
+from lru_cache import LRUCache
+
+# Indexes of channel months kept in memory
+INDEX_CACHE_SIZE = 64
+
+_indexes = LRUCache(INDEX_CACHE_SIZE)
+
+
+class ReactionIndex:
+    """Reactions of the messages of a channel month, in columnar form.
+
+    Reaction names are sorted; for the i-th one, positions[offsets[i]:offsets[i + 1]]
+    are the positions (in the month's message list) of the messages having it
+    and counts[...] the times each got it. totals[i] is the sum of those counts.
+    """
+
+    __slots__ = ("names", "offsets", "positions", "counts", "totals", "_slots")
+
+    def __init__(self, names, offsets, positions, counts, totals):
+        self.names = names
+        self.offsets = offsets
+        self.positions = positions
+        self.counts = counts
+        self.totals = totals
+        self._slots = {name: slot for slot, name in enumerate(names)}
+
+    @classmethod
+    def build(cls, messages):
+        by_name = {}
+        for position, message in enumerate(messages):
+            for reaction in message.get("reactions", ()):
+                if reaction["name"] in by_name:
+                    by_name[reaction["name"]].append((position, reaction["count"]))
+                else:
+                    by_name[reaction["name"]] = [(position, reaction["count"])]
+
+        names = sorted(by_name)
+        offsets = array("I", [0])
+        positions = array("I")
+        counts = array("I")
+        totals = array("Q")
+        for name in names:
+            reactions = by_name[name]
+            positions.extend(position for position, count in reactions)
+            counts.extend(count for position, count in reactions)
+            totals.append(sum(count for position, count in reactions))
+            offsets.append(len(positions))
+        return cls(names, offsets, positions, counts, totals)
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(
+            data["names"],
+            array("I", data["offsets"]),
+            array("I", data["positions"]),
+            array("I", data["counts"]),
+            array("Q", data["totals"]),
+        )
+
+    def toDict(self):
+        # JSON friendly form, stored with the month in the message cache
+        return {
+            "names": self.names,
+            "offsets": self.offsets.tolist(),
+            "positions": self.positions.tolist(),
+            "counts": self.counts.tolist(),
+            "totals": self.totals.tolist(),
+        }
+
+    def __contains__(self, name):
+        return name in self._slots
+
+    def positionsOf(self, name):
+        slot = self._slots.get(name)
+        if slot is None:
+            return self.positions[0:0]
+        return self.positions[self.offsets[slot] : self.offsets[slot + 1]]
+
+    def summary(self, names=None):
+        """{name: {"total": reactions, "messages": messages having it}}, for every
+        reaction or only those in names."""
+        result = {}
+        for name in self.names if names is None else names:
+            slot = self._slots.get(name)
+            if slot is None:
+                result[name] = {"total": 0, "messages": 0}
+            else:
+                result[name] = {
+                    "total": self.totals[slot],
+                    "messages": self.offsets[slot + 1] - self.offsets[slot],
+                }
+        return result
+
+    def matching(self, names, match_all=False):
+        """Sorted positions of the messages with any (or all) of the reactions."""
+        if not names:
+            return []
+        sets = [set(self.positionsOf(name)) for name in names]
+        if match_all:
+            return sorted(set.intersection(*sets))
+        return sorted(set.union(*sets))
+
+
+def forMonth(key, entry):
+    """Index of a message cache entry, built from its messages when the entry
+    predates the index. key must change whenever the entry does."""
+    index = _indexes.get(key)
+    if index is None:
+        if entry.get("reactions") is not None:
+            index = ReactionIndex.fromDict(entry["reactions"])
+        else:
+            index = ReactionIndex.build(entry["messages"])
+        _indexes.put(key, index)
+    return index
@@ -0,0 +1,197 @@
+import heapq
+import math
+import re
+import threading
+from bisect import bisect_left
+
+# Positions of the searchable columns in a "SELECT *" row of the questions table
+# (id, question, answer, user_question, user_answer, related, keywords, aux_keywords, score)
+ID_COLUMN = 0
+QUESTION_COLUMN = 1
+ANSWER_COLUMN = 2
+
+# Column -> weight of a term found in it when ranking (a match in the question
+# counts more than the same word somewhere in a long answer)
+FIELD_WEIGHTS = {1: 3.0, 2: 1.0, 6: 2.0, 7: 1.0}
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Terms only reached through prefix expansion rank below exact matches
+PREFIX_MATCH_WEIGHT = 0.5
+# Shorter query tokens only match whole terms: "d" would otherwise expand to a
+# good part of the vocabulary and score most of the table
+PREFIX_MIN_LENGTH = 3
+
+SNIPPET_LENGTH = 160
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+_lock = threading.Lock()
+_rows = {}
+_postings = {}
+_lengths = {}
+_total_length = 0.0
+_terms = []
+_loaded = False
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def _rowFrequencies(row):
+    frequencies = {}
+    for column, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(row[column]):
+            frequencies[token] = frequencies.get(token, 0.0) + weight
+    return frequencies
+
+
+def _indexRow(row, postings, lengths):
+    row_id = row[ID_COLUMN]
+    frequencies = _rowFrequencies(row)
+    for token, frequency in frequencies.items():
+        if token in postings:
+            postings[token][row_id] = frequency
+        else:
+            postings[token] = {row_id: frequency}
+    lengths[row_id] = sum(frequencies.values())
+    return lengths[row_id]
+
+
+def rebuild(rows):
+    global _rows, _postings, _lengths, _total_length, _terms, _loaded
+    # Build everything aside and swap it in, so searches never see a half built index
+    new_rows = {}
+    new_postings = {}
+    new_lengths = {}
+    new_total_length = 0.0
+    for row in rows:
+        new_rows[row[ID_COLUMN]] = row
+        new_total_length += _indexRow(row, new_postings, new_lengths)
+    new_terms = sorted(new_postings)
+
+    with _lock:
+        _rows = new_rows
+        _postings = new_postings
+        _lengths = new_lengths
+        _total_length = new_total_length
+        _terms = new_terms
+        _loaded = True
+
+
+def addRows(rows):
+    global _terms, _total_length
+    with _lock:
+        for row in rows:
+            row_id = row[ID_COLUMN]
+            if row_id in _rows:
+                _removeRow(_rows[row_id])
+            _rows[row_id] = row
+            _total_length += _indexRow(row, _postings, _lengths)
+        _terms = sorted(_postings)
+
+
+def _removeRow(row):
+    global _total_length
+    row_id = row[ID_COLUMN]
+    for token in _rowFrequencies(row):
+        frequencies = _postings.get(token)
+        if frequencies is not None:
+            frequencies.pop(row_id, None)
+            if not frequencies:
+                del _postings[token]
+    _total_length -= _lengths.pop(row_id, 0.0)
+
+
+def isLoaded():
+    return _loaded
+
+
+def _expand(token):
+    # Every term that starts with the query token, so "deploy" still finds "deployment"
+    # the way the old LIKE '%q%' query did
+    if len(token) < PREFIX_MIN_LENGTH:
+        if token in _postings:
+            yield token
+        return
+    position = bisect_left(_terms, token)
+    while position < len(_terms) and _terms[position].startswith(token):
+        yield _terms[position]
+        position += 1
+
+
+def _scoreToken(token, average_length):
+    scores = {}
+    total_documents = len(_rows)
+    for term in _expand(token):
+        frequencies = _postings[term]
+        idf = math.log(
+            1 + (total_documents - len(frequencies) + 0.5) / (len(frequencies) + 0.5)
+        )
+        if term != token:
+            idf *= PREFIX_MATCH_WEIGHT
+        for row_id, frequency in frequencies.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * _lengths[row_id] / average_length)
+            score = idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+            # A row reached through several expansions keeps its best one
+            if score > scores.get(row_id, 0.0):
+                scores[row_id] = score
+    return scores
+
+
+def search(query, limit=None, offset=0):
+    """Rank the rows matching every query token with BM25.
+
+    Returns the total number of matches and the requested page as a list of
+    (score, row) tuples, best first.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return 0, []
+    with _lock:
+        if not _rows:
+            return 0, []
+        average_length = (_total_length / len(_rows)) or 1.0
+        totals = None
+        for token in sorted(set(tokens), key=len, reverse=True):
+            scores = _scoreToken(token, average_length)
+            if totals is None:
+                totals = scores
+            else:
+                totals = {
+                    row_id: totals[row_id] + score
+                    for row_id, score in scores.items()
+                    if row_id in totals
+                }
+            if not totals:
+                return 0, []
+        # Only the rows up to the requested page are ordered
+        key = lambda x: (-x[1], str(x[0]))
+        if limit is None:
+            ranked = sorted(totals.items(), key=key)[offset:]
+        else:
+            ranked = heapq.nsmallest(offset + limit, totals.items(), key=key)[offset:]
+        return len(totals), [(score, _rows[row_id]) for row_id, score in ranked]
+
+
+def snippet(row, query):
+    """Short extract of the question (or the answer when only it matches)
+    around the first query term."""
+    tokens = tokenize(query)
+    for column in (QUESTION_COLUMN, ANSWER_COLUMN):
+        text = str(row[column] or "")
+        lowered = text.lower()
+        positions = [lowered.find(token) for token in tokens]
+        positions = [position for position in positions if position >= 0]
+        if positions:
+            start = max(min(positions) - SNIPPET_LENGTH // 4, 0)
+            extract = text[start : start + SNIPPET_LENGTH]
+            return ("..." if start > 0 else "") + extract + (
+                "..." if start + SNIPPET_LENGTH < len(text) else ""
+            )
+    text = str(row[QUESTION_COLUMN] or "")
+    return text[:SNIPPET_LENGTH] + ("..." if len(text) > SNIPPET_LENGTH else "")
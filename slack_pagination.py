@@ -0,0 +1,129 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from slack_sdk.errors import SlackApiError
+import metrics
+
+# Requests per minute allowed by the Slack tier of each Web API method we use
+# (https://api.slack.com/docs/rate-limits)
+METHOD_RATE_LIMITS = {
+    "users_list": 20,
+    "search_messages": 20,
+    "conversations_history": 50,
+    "conversations_members": 100,
+    "users_info": 100,
+}
+DEFAULT_RATE_LIMIT = 20
+# Retries of a call answered with HTTP 429 before giving up
+MAX_RETRIES = 5
+# Pages of search results fetched at the same time
+PAGE_CONCURRENCY = 4
+
+
+class TokenBucket:
+    """Allows rate_per_minute calls per minute with bursts of up to burst calls."""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst or max(1, rate_per_minute // 10))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Slack asked us to back off: nobody gets a token for that long
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def getBucket(method_name):
+    with _buckets_lock:
+        if method_name not in _buckets:
+            _buckets[method_name] = TokenBucket(
+                METHOD_RATE_LIMITS.get(method_name, DEFAULT_RATE_LIMIT)
+            )
+        return _buckets[method_name]
+
+
+def callSlack(method, **kwargs):
+    """Calls a WebClient method within its tier limit, honouring Retry-After on
+    HTTP 429. Returns the response data."""
+    method_name = method.__name__
+    bucket = getBucket(method_name)
+    retries = 0
+    while True:
+        with metrics.timed("slack_rate_limit_wait", method=method_name):
+            bucket.acquire()
+        try:
+            with metrics.timed("slack_call", method=method_name):
+                return method(**kwargs).data
+        except SlackApiError as err:
+            status = err.response.status_code
+            metrics.increment("slack_errors_total", method=method_name, status=status)
+            if status != 429 or retries >= MAX_RETRIES:
+                raise
+            retries += 1
+            metrics.increment("slack_retries_total", method=method_name)
+            retry_after = float(err.response.headers.get("Retry-After", 1))
+            bucket.pause(retry_after)
+            time.sleep(retry_after)
+
+
+def nextCursor(data):
+    return (data.get("response_metadata") or {}).get("next_cursor") or None
+
+
+def paginateCursor(method, **kwargs):
+    """Yields the data of every page of a cursor paginated method.
+
+    The next page is requested as soon as the current one arrives, so it
+    downloads while the caller processes the current one.
+    """
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(callSlack, method, **kwargs)
+        while pending is not None:
+            data = pending.result()
+            metrics.increment("slack_pages_total", method=method.__name__)
+            cursor = nextCursor(data)
+            pending = (
+                prefetcher.submit(callSlack, method, **dict(kwargs, cursor=cursor))
+                if cursor
+                else None
+            )
+            yield data
+
+
+def paginatePages(method, paging_key, **kwargs):
+    """Yields, in order, the data of every page of a page numbered method
+    (search.messages). After the first page tells how many there are, the rest
+    are fetched concurrently."""
+    first = callSlack(method, page=1, **kwargs)
+    metrics.increment("slack_pages_total", method=method.__name__)
+    yield first
+    pages = first[paging_key]["paging"]["pages"]
+    if pages <= 1:
+        return
+    with ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY) as pool:
+        for data in pool.map(
+            lambda page: callSlack(method, page=page, **kwargs), range(2, pages + 1)
+        ):
+            metrics.increment("slack_pages_total", method=method.__name__)
+            yield data
@@ -0,0 +1,15 @@
+import os
+import sys
+
+# The app is a set of top-level modules run from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def stand_in(monkeypatch, tmp_path):
+    # SQLite in place of MySQL, undone after the test unlike the benchmarks'
+    # own use of the stand-ins
+    run = pytest.importorskip("benchmarks.run")
+    return run.useStandIns(str(tmp_path), monkeypatch.setattr)
@@ -0,0 +1,126 @@
+"""Keyword postings must hold the same keywords whichever path wrote them, and
+related questions computed on them must rank like the old string-split scorer."""
+from array import array
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("mysql.connector")
+pytest.importorskip("slack_sdk")
+
+import importer  # noqa: E402
+import keyword_vocabulary  # noqa: E402
+import update_related  # noqa: E402
+from benchmarks.fakes import POSTINGS_TABLE, QUESTIONS_TABLE, VOCABULARY_TABLE  # noqa: E402
+
+# RAKE phrases keep the punctuation of the message, commas included
+KEYWORD_LISTS = [
+    (["hi, team", "hi,", "do i, deploy"], ["deploy"]),
+    (["deploy", "team"], []),
+    (["hi", "do i", "vpn, access"], ["team"]),
+    (["vpn", "access", "hi, team"], []),
+    (["certificate"], []),
+    ([], []),
+    (["do i, deploy", "vpn"], ["hi,"]),
+]
+
+
+def splitScorer(columns, top_k=update_related.RELATED_TOP_K):
+    # The scorer before keyword ids: overlap of the comma split keyword columns,
+    # best first, ties in table order. Pieces are normalized like the vocabulary.
+    keyword_sets = [
+        {keyword_vocabulary.normalize(keyword) for keyword in column.split(",")} - {""}
+        for column in columns
+    ]
+    related = {}
+    for position, keywords in enumerate(keyword_sets):
+        scores = {}
+        for other, other_keywords in enumerate(keyword_sets):
+            shared = len(keywords & other_keywords)
+            if other != position and shared > 0:
+                scores[other] = shared
+        related[position] = [
+            other
+            for other, score in sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        ][:top_k]
+    return related
+
+
+def elements():
+    return [
+        {
+            "ts": "1600000000.{:06d}".format(position),
+            "text": "question {}".format(position),
+            "user": "U1",
+            "response": {"text": "answer", "user": "U2"},
+            "related": [],
+            "keywords": keywords,
+            "aux_keywords": aux_keywords,
+        }
+        for position, (keywords, aux_keywords) in enumerate(KEYWORD_LISTS)
+    ]
+
+
+def readPostings(stand_in):
+    with stand_in.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            "SELECT p.question_id, p.field, v.keyword FROM " + POSTINGS_TABLE + " p "
+            "JOIN " + VOCABULARY_TABLE + " v ON v.id = p.keyword_id"
+        )
+        return sorted(cursor.fetchall())
+
+
+def test_import_and_rebuild_write_the_same_postings(stand_in):
+    importer.insertData(elements())
+    imported = readPostings(stand_in)
+    with stand_in.connection() as cnx:
+        keyword_vocabulary.indexAllQuestions(cnx.cursor())
+        cnx.commit()
+    assert readPostings(stand_in) == imported
+    keywords = {keyword for question_id, field, keyword in imported}
+    assert "hi" in keywords and "hi, team" not in keywords
+
+
+def test_related_matches_the_split_scorer():
+    columns = [",".join(keywords) for keywords, aux_keywords in KEYWORD_LISTS]
+    vocabulary = {}
+    keyword_ids = [
+        array(
+            "I",
+            sorted(
+                {
+                    vocabulary.setdefault(keyword, len(vocabulary))
+                    for keyword in map(
+                        keyword_vocabulary.normalize,
+                        keyword_vocabulary.splitColumn(column),
+                    )
+                    if keyword
+                }
+            ),
+        )
+        for column in columns
+    ]
+    ids = [str(position) for position in range(len(columns))]
+    assert update_related.computeRelated(ids, keyword_ids) == splitScorer(columns)
+
+
+def test_related_matches_the_split_scorer_with_dense_keywords(monkeypatch):
+    # Every keyword scored with bitsets
+    monkeypatch.setattr(update_related, "DENSE_KEYWORD_MIN_POSTINGS", 1)
+    test_related_matches_the_split_scorer()
+
+
+def test_related_after_insert_uses_the_split_keywords(stand_in):
+    importer.insertData(elements())
+    update_related.updateRelatedQuestions()
+    with stand_in.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute("SELECT id, related FROM " + QUESTIONS_TABLE + " ORDER BY id")
+        rows = cursor.fetchall()
+    ids = [row[0] for row in rows]
+    columns = [",".join(keywords) for keywords, aux_keywords in KEYWORD_LISTS]
+    expected = splitScorer(columns)
+    assert [row[1] for row in rows] == [
+        ",".join(ids[other] for other in expected[position])
+        for position in range(len(ids))
+    ]
@@ -0,0 +1,61 @@
+"""An incremental related run must leave the related column exactly as a full
+run would."""
+import random
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("mysql.connector")
+pytest.importorskip("slack_sdk")
+
+import importer  # noqa: E402
+import update_related  # noqa: E402
+from benchmarks.fakes import QUESTIONS_TABLE  # noqa: E402
+
+KEYWORDS = ["deploy", "vpn", "access", "team", "certificate", "dns", "build", "cache"]
+
+
+def element(position, rng):
+    return {
+        "ts": "1600000000.{:06d}".format(position),
+        "text": "question {}".format(position),
+        "user": "U1",
+        "response": {"text": "answer", "user": "U2"},
+        "related": [],
+        "keywords": rng.sample(KEYWORDS, rng.randint(0, 4)),
+        "aux_keywords": [],
+    }
+
+
+def readRelated(stand_in):
+    with stand_in.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute("SELECT id, related FROM " + QUESTIONS_TABLE + " ORDER BY id")
+        return cursor.fetchall()
+
+
+@pytest.mark.parametrize("dense_min_postings", [update_related.DENSE_KEYWORD_MIN_POSTINGS, 1])
+def test_incremental_run_matches_a_full_run(stand_in, monkeypatch, dense_min_postings):
+    monkeypatch.setattr(update_related, "DENSE_KEYWORD_MIN_POSTINGS", dense_min_postings)
+    # Small enough a delta to never fall back to a full run
+    monkeypatch.setattr(update_related, "RELATED_INCREMENTAL_MAX_SHARE", 1)
+    rng = random.Random(5)
+    importer.insertData([element(position, rng) for position in range(60)])
+    update_related.updateRelatedQuestions(incremental=True)
+
+    # New, changed and deleted questions
+    importer.insertData(
+        [element(position, rng) for position in rng.sample(range(60), 8)]
+        + [element(position, rng) for position in range(60, 66)]
+    )
+    with stand_in.connection() as cnx:
+        cursor = cnx.cursor()
+        cursor.execute(
+            "DELETE FROM " + QUESTIONS_TABLE + " WHERE id IN (%s, %s, %s)",
+            ["1600000000.000003", "1600000000.000017", "1600000000.000061"],
+        )
+        cnx.commit()
+    update_related.updateRelatedQuestions(incremental=True)
+    incremental = readRelated(stand_in)
+
+    assert update_related.updateRelatedQuestions() == 0
+    assert readRelated(stand_in) == incremental
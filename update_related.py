@@ -1,6 +1,13 @@
-import mysql.connector
+import json
 import os
+import zlib
+from array import array
+from collections import Counter
+from itertools import chain
 from dotenv import load_dotenv
+import database
+import keyword_vocabulary
+import metrics
 
 TEST_MODE = False
 # Allows us to access the .env file
@@ -10,59 +17,357 @@ if TEST_MODE:
 else:
     load_dotenv(".env.production")
 
-DATABASE_DIRECTION = os.getenv("DATABASE_DIRECTION")
-DATABASE_USER = os.getenv("DATABASE_USER")
-DATABASE_PASSWORD = os.getenv("DATABSE_PASSWORD")
-DATABASE_NAME = os.getenv("DATABASE_NAME")
 DATABASE_TABLE = os.getenv("DATABASE_TABLE")
 
+# Number of related questions stored per question
+RELATED_TOP_K = 10
+RELATED_UPDATE_BATCH_SIZE = 500
+# Keyword fingerprints from the last run, used to find new and changed questions
+RELATED_STATE_FILE = "user_data/related_state.json"
+# Keywords found in more than 1/DENSE_KEYWORD_SHARE of the questions are scored
+# with bitsets instead of walking their (long) posting lists
+DENSE_KEYWORD_SHARE = 128
+DENSE_KEYWORD_MIN_POSTINGS = 64
+# Incremental runs changing more than this share of the questions recompute all
+RELATED_INCREMENTAL_MAX_SHARE = 0.05
 
-def updateRelatedQuestions():
-    get_related_questions = "SELECT * FROM " + DATABASE_TABLE
-    cnx = mysql.connector.connect(
-        user=DATABASE_NAME,
-        password=DATABASE_PASSWORD,
-        host=DATABASE_DIRECTION,
-        database=DATABASE_NAME,
+
+def buildKeywordIndex(keyword_ids):
+    # keyword id -> positions of the questions that have it
+    postings = {}
+    for position, keywords in enumerate(keyword_ids):
+        for keyword in keywords:
+            if keyword in postings:
+                postings[keyword].append(position)
+            else:
+                postings[keyword] = [position]
+    return postings
+
+
+def overlapScores(position, keyword_ids, postings):
+    # Only questions sharing at least one keyword are ever looked at; the score is
+    # the number of shared keywords
+    scores = Counter(
+        chain.from_iterable(postings[keyword] for keyword in keyword_ids[position])
     )
-    cursor = cnx.cursor()
-    cursor.execute(get_related_questions)
-    myresult = cursor.fetchall()
-
-    data = []
-    for result in myresult:
-        aux = list(result)
-        aux[5] = aux[5].split(",")
-        aux[6] = aux[6].split(",")
-        data.append(aux)
-
-    for each_message_i in data:
-        scores = {}
-        for each_message_j in data:
-            if (
-                each_message_i[0] != each_message_j[0]
-                and len(set(each_message_i[6]).intersection(each_message_j[6])) > 0
-            ):
-                scores[each_message_j[0]] = len(
-                    set(each_message_i[6]).intersection(each_message_j[6])
-                )
-        scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:20]
-        each_message_i[5] = []
-        for score in scores:
-            each_message_i[5].append(score[0])
-
-    add_question = (
-        "UPDATE " + DATABASE_TABLE + " SET related=%(related)s " "WHERE id=%(id)s"
+    scores.pop(position, None)
+    return scores
+
+
+def rankRelated(scores, top_k=RELATED_TOP_K):
+    # Both sorts are stable, so equal scores stay ordered by position
+    return sorted(sorted(scores), key=scores.__getitem__, reverse=True)[:top_k]
+
+
+def topRelated(position, keyword_ids, postings, top_k=RELATED_TOP_K):
+    return rankRelated(overlapScores(position, keyword_ids, postings), top_k)
+
+
+def sharedKeywords(keywords, other_keywords):
+    return len(set(keywords).intersection(other_keywords))
+
+
+def toBitset(positions, size):
+    bits = bytearray((size >> 3) + 1)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+def denseBitsets(postings, size):
+    # keyword id -> bitset of its questions, for the most common keywords only
+    threshold = max(DENSE_KEYWORD_MIN_POSTINGS, size // DENSE_KEYWORD_SHARE)
+    return {
+        keyword: toBitset(positions, size)
+        for keyword, positions in postings.items()
+        if len(positions) >= threshold
+    }
+
+
+def bitSlicedScores(sparse_scores, dense_keywords, size):
+    """Scores of every question as bit planes: bit p of planes[i] is bit i of
+    the score of position p. The sparse scores are laid out first, then each
+    dense keyword bitset is added with a ripple carry, a whole column of
+    questions per big integer operation."""
+    planes = []
+    for bit in range(max(sparse_scores.values(), default=0).bit_length()):
+        planes.append(
+            toBitset(
+                (position for position, score in sparse_scores.items() if score >> bit & 1),
+                size,
+            )
+        )
+    for bitset in dense_keywords:
+        carry = bitset
+        for plane_number, plane in enumerate(planes):
+            planes[plane_number] = plane ^ carry
+            carry &= plane
+            if not carry:
+                break
+        if carry:
+            planes.append(carry)
+    return planes
+
+
+def rankBitSliced(planes, position, top_k=RELATED_TOP_K):
+    # Same order as rankRelated: highest score first, then lowest position
+    remaining = 0
+    for plane in planes:
+        remaining |= plane
+    remaining &= ~(1 << position)
+    related = []
+    while remaining and len(related) < top_k:
+        # Narrowing from the highest plane down leaves the best scoring positions
+        best = remaining
+        for plane in reversed(planes):
+            if best & plane:
+                best &= plane
+        remaining ^= best
+        while best and len(related) < top_k:
+            lowest = best & -best
+            related.append(lowest.bit_length() - 1)
+            best ^= lowest
+    return related
+
+
+def relatedPlanes(position, keyword_ids, postings, bitsets, size):
+    # Bit-sliced scores of every question against the one at position
+    keywords = keyword_ids[position]
+    sparse_scores = Counter(
+        chain.from_iterable(
+            postings[keyword] for keyword in keywords if keyword not in bitsets
+        )
     )
+    dense = [bitsets[keyword] for keyword in keywords if keyword in bitsets]
+    return bitSlicedScores(sparse_scores, dense, size)
+
+
+def relatedOf(position, keyword_ids, postings, bitsets, top_k=RELATED_TOP_K):
+    if not any(keyword in bitsets for keyword in keyword_ids[position]):
+        return topRelated(position, keyword_ids, postings, top_k)
+    planes = relatedPlanes(position, keyword_ids, postings, bitsets, len(keyword_ids))
+    return rankBitSliced(planes, position, top_k)
+
+
+def toPlanes(values, size):
+    # position -> value as bit planes, like bitSlicedScores
+    return [
+        toBitset(
+            (position for position, value in values.items() if value >> bit & 1), size
+        )
+        for bit in range(max(values.values(), default=0).bit_length())
+    ]
 
-    for each_message in data:
-        each_message[5] = str(",".join([item for item in each_message[5]][:10]))
 
-        data_question = {"id": each_message[0], "related": each_message[5]}
+def compareSliced(planes, other_planes, universe):
+    """(greater, equal) bitsets of the positions where the number in planes is
+    greater than, or equal to, the one in other_planes."""
+    greater = 0
+    equal = universe
+    for bit in reversed(range(max(len(planes), len(other_planes)))):
+        plane = planes[bit] if bit < len(planes) else 0
+        other_plane = other_planes[bit] if bit < len(other_planes) else 0
+        greater |= equal & plane & ~other_plane
+        equal &= ~(plane ^ other_plane)
+    return greater, equal
+
+
+def computeRelated(ids, keyword_ids, top_k=RELATED_TOP_K):
+    """Related positions of every question. keyword_ids holds, per question, the
+    ids of its distinct keywords (see keyword_vocabulary)."""
+    postings = buildKeywordIndex(keyword_ids)
+    bitsets = denseBitsets(postings, len(ids))
+    return {
+        position: relatedOf(position, keyword_ids, postings, bitsets, top_k)
+        for position in range(len(keyword_ids))
+    }
+
+
+def incrementalRelated(
+    ids, keyword_ids, current_related, changed_ids, top_k=RELATED_TOP_K
+):
+    """Related positions for the questions affected by changed_ids only.
+
+    Changed questions, and questions listing a changed or deleted id, are
+    recomputed. Every other question keeps its current list unless a changed
+    question now scores into it. A delta above RELATED_INCREMENTAL_MAX_SHARE of
+    the table is cheaper to do as a full computeRelated.
+    """
+    position_of = {str(id): position for position, id in enumerate(ids)}
+    delta = [position_of[id] for id in changed_ids if id in position_of]
+    if len(delta) > len(ids) * RELATED_INCREMENTAL_MAX_SHARE:
+        return computeRelated(ids, keyword_ids, top_k)
+    postings = buildKeywordIndex(keyword_ids)
+    bitsets = denseBitsets(postings, len(ids))
+
+    recompute = set(delta)
+    for position, related_ids in enumerate(current_related):
+        if not changed_ids.isdisjoint(related_ids):
+            recompute.add(position)
+
+    # Score and position of the last related question of every full list, as
+    # bit planes: a changed question enters the list of every position where
+    # it beats that score, or ties it and comes first
+    last_scores = {}
+    last_positions = {}
+    for position, related_ids in enumerate(current_related):
+        if position not in recompute and len(related_ids) >= top_k:
+            last = position_of[related_ids[top_k - 1]]
+            last_scores[position] = sharedKeywords(
+                keyword_ids[position], keyword_ids[last]
+            )
+            last_positions[position] = last
+    size = len(ids)
+    universe = (1 << size) - 1
+    last_score_planes = toPlanes(last_scores, size)
+    last_position_planes = toPlanes(last_positions, size)
+    candidates = universe & ~toBitset(recompute, size)
+
+    updated = {}
+    entrants = {}
+    for changed in delta:
+        planes = relatedPlanes(changed, keyword_ids, postings, bitsets, size)
+        updated[changed] = rankBitSliced(planes, changed, top_k)
+        scored = 0
+        for plane in planes:
+            scored |= plane
+        beats, ties = compareSliced(planes, last_score_planes, universe)
+        # changed repeated at every position
+        changed_planes = [
+            universe if changed >> bit & 1 else 0
+            for bit in range(changed.bit_length())
+        ]
+        after, same = compareSliced(last_position_planes, changed_planes, universe)
+        entering = (beats | ties & after) & scored & candidates
+        while entering:
+            lowest = entering & -entering
+            position = lowest.bit_length() - 1
+            entering ^= lowest
+            if position in entrants:
+                entrants[position].append(changed)
+            else:
+                entrants[position] = [changed]
+
+    for position in recompute:
+        if position not in updated:
+            updated[position] = relatedOf(
+                position, keyword_ids, postings, bitsets, top_k
+            )
+
+    for position, new_positions in entrants.items():
+        scores = {
+            candidate: sharedKeywords(keyword_ids[position], keyword_ids[candidate])
+            for candidate in set(new_positions).union(
+                position_of[id] for id in current_related[position]
+            )
+        }
+        updated[position] = rankRelated(scores, top_k)
+
+    return updated
+
+
+def loadRelatedState():
+    try:
+        with open(RELATED_STATE_FILE) as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return None
+
+
+def saveRelatedState(fingerprints):
+    temporary_file = RELATED_STATE_FILE + ".tmp"
+    with open(temporary_file, "w") as state_file:
+        json.dump({"fingerprints": fingerprints}, state_file, separators=(",", ":"))
+    os.replace(temporary_file, RELATED_STATE_FILE)
+
+
+def writeRelated(updates):
+    # One "UPDATE ... CASE" statement per batch instead of one UPDATE per row
+    with database.connection() as cnx:
+        cursor = cnx.cursor()
+        for start in range(0, len(updates), RELATED_UPDATE_BATCH_SIZE):
+            batch = updates[start : start + RELATED_UPDATE_BATCH_SIZE]
+            statement = (
+                "UPDATE " + DATABASE_TABLE + " SET related = CASE id "
+                + "WHEN %s THEN %s " * len(batch)
+                + "END WHERE id IN ("
+                + ", ".join(["%s"] * len(batch))
+                + ")"
+            )
+            params = [value for update in batch for value in update]
+            params += [update[0] for update in batch]
+            cursor.execute(statement, params)
+        cnx.commit()
+        cursor.close()
+
+
+def updateRelatedQuestions(incremental=False):
+    """Recompute the related column.
+
+    In incremental mode only questions added or changed since the last run
+    (and the questions they enter or leave) are recomputed. The first run, or
+    a run without saved state, does the whole table.
+    """
+    get_related_questions = (
+        "SELECT id, related FROM " + DATABASE_TABLE + " ORDER BY id"
+    )
+    # Keyword ids of every question, sorted, instead of re-splitting the
+    # comma joined keywords column
+    get_keyword_postings = (
+        "SELECT q.id, p.keyword_id FROM " + DATABASE_TABLE + " q "
+        "JOIN " + keyword_vocabulary.POSTINGS_TABLE + " p ON p.question_id = q.id "
+        "WHERE p.field = %s ORDER BY q.id, p.keyword_id"
+    )
+    with metrics.timed("related_stage", stage="load"), database.connection() as cnx:
+        keyword_vocabulary.ensureTables(cnx)
+        cursor = cnx.cursor()
+        cursor.execute(get_related_questions)
+        myresult = cursor.fetchall()
+        cursor.execute(get_keyword_postings, (keyword_vocabulary.KEYWORDS_FIELD,))
+        keyword_postings = cursor.fetchall()
+        cursor.close()
+
+    ids = [result[0] for result in myresult]
+    current_columns = [result[1] or "" for result in myresult]
+    position_of = {id: position for position, id in enumerate(ids)}
+    keyword_ids = [array("I") for _ in ids]
+    for id, keyword_id in keyword_postings:
+        keyword_ids[position_of[id]].append(keyword_id)
+    fingerprints = {
+        str(id): zlib.crc32(keywords.tobytes())
+        for id, keywords in zip(ids, keyword_ids)
+    }
 
-        cursor.execute(add_question, data_question)
+    state = loadRelatedState() if incremental else None
+    mode = "incremental" if state is not None else "full"
+    compute = metrics.timed("related_stage", stage="compute", mode=mode)
+    if state is None:
+        with compute:
+            related = computeRelated(ids, keyword_ids)
+    else:
+        previous = state["fingerprints"]
+        changed_ids = {
+            id for id, fingerprint in fingerprints.items()
+            if previous.get(id) != fingerprint
+        }
+        changed_ids.update(id for id in previous if id not in fingerprints)
+        current_related = [
+            column.split(",") if column else [] for column in current_columns
+        ]
+        with compute:
+            related = incrementalRelated(
+                ids, keyword_ids, current_related, changed_ids
+            )
 
-    cnx.commit()
+    updates = []
+    for position, related_positions in related.items():
+        column = ",".join(str(ids[other]) for other in related_positions)
+        if column != current_columns[position]:
+            updates.append((ids[position], column))
 
-    cursor.close()
-    cnx.close()
+    with metrics.timed("related_stage", stage="write"):
+        writeRelated(updates)
+    saveRelatedState(fingerprints)
+    metrics.increment("related_rows_written_total", len(updates))
+    metrics.setGauge("related_questions", len(ids))
+    return len(updates)
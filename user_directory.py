@@ -0,0 +1,187 @@
+import csv
+import logging
+import os
+import threading
+import time
+import metrics
+
+# Columns of the user_data/workspace snapshot. Those in PROFILE_COLUMNS live
+# under user["profile"] in the Slack user objects.
+SNAPSHOT_COLUMNS = [
+    "id",
+    "team_id",
+    "name",
+    "deleted",
+    "real_name",
+    "tz_label",
+    "title",
+    "phone",
+    "display_name",
+    "first_name",
+    "last_name",
+    "image_512",
+    "team",
+    "is_admin",
+    "is_owner",
+    "is_primary_owner",
+    "is_restricted",
+    "is_ultra_restricted",
+    "is_bot",
+    "is_app_user",
+    "updated",
+    "is_email_confirmed",
+]
+PROFILE_COLUMNS = {
+    "title",
+    "phone",
+    "display_name",
+    "first_name",
+    "last_name",
+    "image_512",
+    "team",
+}
+BOOLEAN_COLUMNS = {
+    "deleted",
+    "is_admin",
+    "is_owner",
+    "is_primary_owner",
+    "is_restricted",
+    "is_ultra_restricted",
+    "is_bot",
+    "is_app_user",
+    "is_email_confirmed",
+}
+
+
+def userToRow(user):
+    profile = user.get("profile") or {}
+    row = {}
+    for column in SNAPSHOT_COLUMNS:
+        row[column] = profile.get(column) if column in PROFILE_COLUMNS else user.get(column)
+    return row
+
+
+def rowToUser(row):
+    user = {"profile": {}}
+    for column in SNAPSHOT_COLUMNS:
+        value = row.get(column)
+        if value is None or value == "":
+            continue
+        if column in BOOLEAN_COLUMNS:
+            value = value == "True"
+        elif column == "updated":
+            value = int(value)
+        if column in PROFILE_COLUMNS:
+            user["profile"][column] = value
+        else:
+            user[column] = value
+    return user
+
+
+class UserDirectory:
+    """Process wide id -> Slack user map.
+
+    Starts from the CSV snapshot, is refreshed from users.list when older than
+    ttl seconds (in the background once it has data) and only replaces users
+    whose "updated" field changed. Users missing from the map are fetched one by
+    one with users.info.
+    """
+
+    def __init__(self, fetch_users, fetch_user, ttl, snapshot_file):
+        self.fetch_users = fetch_users
+        self.fetch_user = fetch_user
+        self.ttl = ttl
+        self.snapshot_file = snapshot_file
+        self._users = {}
+        # Users loaded from the snapshot only have the snapshot columns
+        self._from_snapshot = set()
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def loadSnapshot(self):
+        try:
+            with open(self.snapshot_file, newline="") as snapshot:
+                users = {row["id"]: rowToUser(row) for row in csv.DictReader(snapshot)}
+            refreshed_at = os.path.getmtime(self.snapshot_file)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._users = users
+            self._from_snapshot = set(users)
+            self._refreshed_at = refreshed_at
+
+    def saveSnapshot(self):
+        with self._lock:
+            users = list(self._users.values())
+        temporary_file = self.snapshot_file + ".tmp"
+        with open(temporary_file, "w", newline="") as snapshot:
+            writer = csv.DictWriter(snapshot, fieldnames=SNAPSHOT_COLUMNS)
+            writer.writeheader()
+            for user in users:
+                writer.writerow(userToRow(user))
+        os.replace(temporary_file, self.snapshot_file)
+
+    def refresh(self, blocking=False):
+        # A single crawl at a time; callers arriving meanwhile skip it, or wait for
+        # it and use its result when blocking
+        if not self._refresh_lock.acquire(blocking=blocking):
+            return
+        try:
+            if blocking and self._users and not self.isStale():
+                return
+            with metrics.timed("user_directory_refresh", stage="fetch"):
+                users = self.fetch_users()
+            changed = 0
+            with metrics.timed("user_directory_refresh", stage="merge"), self._lock:
+                fetched_ids = set()
+                for user in users:
+                    fetched_ids.add(user["id"])
+                    current = self._users.get(user["id"])
+                    if (
+                        current is None
+                        or user["id"] in self._from_snapshot
+                        or current.get("updated") != user.get("updated")
+                    ):
+                        self._users[user["id"]] = user
+                        self._from_snapshot.discard(user["id"])
+                        changed += 1
+                for user_id in set(self._users) - fetched_ids:
+                    del self._users[user_id]
+                    self._from_snapshot.discard(user_id)
+                    changed += 1
+                self._refreshed_at = time.time()
+            metrics.setGauge("user_directory_users", len(self._users))
+            if changed:
+                self.saveSnapshot()
+        finally:
+            self._refresh_lock.release()
+
+    def refreshInBackground(self):
+        def run():
+            try:
+                self.refresh()
+            except Exception as err:
+                logging.error(f"Could not refresh the user directory: {err}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def isStale(self):
+        return time.time() - self._refreshed_at > self.ttl
+
+    def getUsers(self, user_ids):
+        if not self._users:
+            self.refresh(blocking=True)
+        elif self.isStale():
+            self.refreshInBackground()
+
+        users = []
+        for user_id in user_ids:
+            user = self._users.get(user_id)
+            if user is None:
+                metrics.increment("user_directory_misses_total")
+                user = self.fetch_user(user_id)
+                with self._lock:
+                    self._users[user_id] = user
+            users.append(user)
+        return users
@@ -0,0 +1,66 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteCoalescer:
+    """Groups the items submitted within window seconds of each other (at most
+    max_batch) into a single write(items) call, run on a background thread.
+
+    write returns one result per item; submit returns a Future for the result
+    of its item, or for the exception raised by write. When a batch fails its
+    items are written again one at a time. Items arriving while a batch is
+    being written wait for the next one.
+    """
+
+    def __init__(self, write, window, max_batch, name="writer"):
+        self.write = write
+        self.window = window
+        self.max_batch = max_batch
+        self.name = name
+        self._pending = []
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)
+        self._thread = None
+
+    def submit(self, item):
+        future = Future()
+        with self._lock:
+            self._pending.append((item, future))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+            self._arrived.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._arrived.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._arrived.wait(remaining)
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            results = self.write([item for item, future in batch])
+        except Exception as err:
+            if len(batch) == 1:
+                batch[0][1].set_exception(err)
+                return
+            # One bad item fails the whole batch: write them one by one so only
+            # that item's caller gets the error
+            for entry in batch:
+                self._flush([entry])
+            return
+        for (item, future), result in zip(batch, results):
+            future.set_result(result)